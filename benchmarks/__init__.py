@@ -0,0 +1 @@
+"""Transport bot benchmarks."""
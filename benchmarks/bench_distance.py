@@ -0,0 +1,73 @@
+"""Micro-benchmark: vectorized distance kernel vs per-pair haversine loop.
+
+Run:
+    python -m benchmarks.bench_distance --points 5000
+"""
+
+import random
+import timeit
+
+import click
+import haversine
+import numpy as np
+
+from transport_bot.api_service.distance import haversine_many_to_many, haversine_one_to_many
+
+CENTER = (51.5074, -0.1278)
+
+
+def random_points(count, seed):
+    """Generate points around the city center."""
+    rnd = random.Random(seed)
+    return [
+        (CENTER[0] + rnd.uniform(-0.2, 0.2), CENTER[1] + rnd.uniform(-0.3, 0.3))
+        for _ in range(count)
+    ]
+
+
+def report(name, loop_seconds, kernel_seconds):
+    """Print timings."""
+    click.echo(
+        f"{name:<14} loop={loop_seconds * 1e3:10.3f} ms  "
+        f"kernel={kernel_seconds * 1e3:8.3f} ms  speedup={loop_seconds / kernel_seconds:7.1f}x"
+    )
+
+
+@click.command()
+@click.option("--points", type=int, default=5000, help="Number of points")
+@click.option("--sources", type=int, default=50, help="Sources for many-to-many")
+@click.option("--repeat", type=int, default=5, help="Best of repeats")
+def main(points, sources, repeat):
+    """Compare per-pair haversine with the vectorized kernel."""
+    targets = random_points(points, seed=1)
+    origins = random_points(sources, seed=2)
+    latitudes = np.array([p[0] for p in targets], dtype=np.float64)
+    longitudes = np.array([p[1] for p in targets], dtype=np.float64)
+    origin_lats = np.array([p[0] for p in origins], dtype=np.float64)
+    origin_lons = np.array([p[1] for p in origins], dtype=np.float64)
+
+    def loop_one():
+        return [haversine.haversine(CENTER, p) for p in targets]
+
+    def kernel_one():
+        return haversine_one_to_many(CENTER[0], CENTER[1], latitudes, longitudes)
+
+    def loop_many():
+        return [[haversine.haversine(o, p) for p in targets] for o in origins]
+
+    def kernel_many():
+        return haversine_many_to_many(origin_lats, origin_lons, latitudes, longitudes)
+
+    assert np.allclose(loop_one(), kernel_one())
+    assert np.allclose(loop_many(), kernel_many())
+
+    def best(fn, number):
+        return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+    click.echo(f"points={points} sources={sources}")
+    report("one-to-many", best(loop_one, 10), best(kernel_one, 100))
+    report("many-to-many", best(loop_many, 1), best(kernel_many, 10))
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,132 @@
+"""Benchmark of driver location updates with and without the fleet store.
+
+Drivers are registered, started and then report random locations near their
+route stops through the Flask test client, to ``put_driver_location``
+(``location``) or to ``put_driver_fast_location`` with a json (``fast_json``)
+or a binary (``fast_binary``) body. Besides wall clock throughput, requests per
+CPU second of the process tell the throughput of one core. The fleet store run
+includes flushes every ``--flush-interval`` seconds and the final flush.
+The in-memory SQLite database has a single connection, which can not be
+written from several threads at once, so updates are sent one at a time
+by default.
+
+Run:
+    python -m benchmarks.bench_location_writes --drivers 200 --requests 5000 \\
+        --endpoint location --endpoint fast_json --endpoint fast_binary
+"""
+
+import concurrent.futures
+import random
+import threading
+import time
+
+import click
+
+from transport_bot.api_service import driver
+from transport_bot.api_service.board import arrival_board
+from transport_bot.api_service.fleet import fleet_store
+from transport_bot.api_service.route import route_data
+from transport_bot.api_service.schema import app, db
+
+from .bench_nearest_driver import create_drivers, percentile
+
+ENDPOINTS = ("location", "fast_json", "fast_binary")
+
+
+def run(drivers, requests_count, concurrency, store, flush_interval, seed, endpoint="location"):
+    """Send location updates.
+
+    :return tuple: (elapsed seconds, CPU seconds, sorted latencies in ms, fleet store stats)
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    fleet_store.set_config(enabled=store)
+    create_drivers(app.test_client(), drivers, seed)
+    if store:
+        with app.app_context():
+            fleet_store.flush()
+        fleet_store.start(app, flush_interval)
+
+    rnd = random.Random(seed)
+    locations = [
+        (stop["location"]["lat"], stop["location"]["lon"]) for stop in route_data["stops"].values()
+    ]
+    updates = [
+        (rnd.randint(1, drivers), rnd.choice(locations), rnd.uniform(-0.001, 0.001))
+        for _ in range(requests_count)
+    ]
+    local = threading.local()
+
+    def request(update):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        messenger_id, (latitude, longitude), shift = update
+        started = time.perf_counter()
+        if endpoint == "fast_binary":
+            response = local.client.put(
+                f"/driver/{messenger_id}/fast_location",
+                data=driver.LOCATION_STRUCT.pack(latitude + shift, longitude + shift),
+                content_type="application/octet-stream",
+            )
+        else:
+            path = "location" if endpoint == "location" else "fast_location"
+            response = local.client.put(
+                f"/driver/{messenger_id}/{path}",
+                json={"latitude": latitude + shift, "longitude": longitude + shift},
+            )
+        assert response.status_code == 200
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(request, updates))
+    if store:
+        fleet_store.stop()
+        with app.app_context():
+            fleet_store.flush()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    return elapsed, cpu, sorted(seconds * 1e3 for seconds in latencies), fleet_store.stats()
+
+
+@click.command()
+@click.option("--routes-json", default="tests/routes.json", help="Routes json")
+@click.option("--drivers", type=int, default=200, help="Connected drivers")
+@click.option("--requests", "requests_count", type=int, default=5000, help="Location updates")
+@click.option("--concurrency", type=int, default=1, help="Concurrent drivers")
+@click.option("--flush-interval", type=float, default=5, help="Fleet store flush interval")
+@click.option(
+    "--endpoint",
+    "endpoints",
+    type=click.Choice(ENDPOINTS),
+    multiple=True,
+    default=["location"],
+    help="Endpoint and body to measure, repeat to compare",
+)
+@click.option("--seed", type=int, default=1, help="Random seed")
+def main(routes_json, drivers, requests_count, concurrency, flush_interval, endpoints, seed):
+    """Measure location update throughput with and without the fleet store."""
+    route_data.load_from_json(routes_json)
+    arrival_board.set_config()
+    click.echo(f"requests={requests_count} concurrency={concurrency} drivers={drivers}")
+    for store in (False, True):
+        for endpoint in endpoints:
+            elapsed, cpu, latencies, stats = run(
+                drivers, requests_count, concurrency, store, flush_interval, seed, endpoint
+            )
+            click.echo(
+                f"fleet_store={store!s:5}  endpoint={endpoint:11}  "
+                f"throughput={requests_count / elapsed:8.1f} req/s  "
+                f"per core={requests_count / cpu:8.1f} req/s  "
+                f"p50={percentile(latencies, 0.5):6.2f} ms  "
+                f"p99={percentile(latencies, 0.99):6.2f} ms"
+            )
+        if store:
+            click.echo(f"stats={stats}")
+    fleet_store.set_config()
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
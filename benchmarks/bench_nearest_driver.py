@@ -0,0 +1,161 @@
+"""End-to-end benchmark of nearest driver search against the local ORS stand-in.
+
+The stand-in runs in-process on a free port, the server is called through the
+Flask test client, so the numbers include validation, database queries, route
+caching and ORS HTTP round trips, but not the server HTTP stack.
+
+Run:
+    python -m benchmarks.bench_nearest_driver --drivers 20 --requests 500 --latency lognormal:0.1:0.5
+"""
+
+import concurrent.futures
+import random
+import statistics
+import threading
+import time
+
+import click
+from werkzeug.serving import make_server
+
+from transport_bot import ors_stub
+from transport_bot.api_service import driver, passenger  # noqa: F401
+from transport_bot.api_service.board import arrival_board
+from transport_bot.api_service.eta import MODES, estimator
+from transport_bot.api_service.fleet import fleet_store
+from transport_bot.api_service.route import route_client, route_data
+from transport_bot.api_service.schema import app, db
+
+
+def start_stub(**kwargs):
+    """Start ORS stand-in in a background thread.
+
+    :return tuple: (server, base url, request counters)
+    """
+    stub = ors_stub.create_app(**kwargs)
+    server = make_server("127.0.0.1", 0, stub, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}", stub.config["ORS_STUB_COUNTERS"]
+
+
+def create_drivers(client, count, seed):
+    """Register connected drivers near stops of random routes."""
+    rnd = random.Random(seed)
+    routes = list(route_data["routes"])
+    for messenger_id in range(1, count + 1):
+        route = rnd.choice(routes)
+        stop = rnd.choice(route_data["routes"][route]["stops"])
+        location = route_data["stops"][stop]["location"]
+        client.post(
+            f"/driver/{messenger_id}",
+            json={
+                "phone": str(messenger_id),
+                "name": f"Driver {messenger_id}",
+                "latitude": location["lat"] + rnd.uniform(-0.01, 0.01),
+                "longitude": location["lon"] + rnd.uniform(-0.01, 0.01),
+                "route": route,
+            },
+        )
+        client.post(f"/driver/{messenger_id}/start")
+
+
+def percentile(values, share):
+    """Get percentile of sorted values."""
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+@click.command()
+@click.option("--routes-json", default="tests/routes.json", help="Routes json")
+@click.option("--drivers", type=int, default=20, help="Connected drivers")
+@click.option("--requests", "requests_count", type=int, default=500, help="Passenger requests")
+@click.option("--concurrency", type=int, default=8, help="Concurrent passengers")
+@click.option("--latency", default="lognormal:0.1:0.5", help="ORS latency distribution")
+@click.option("--error-rate", type=float, default=0, help="Share of ORS HTTP 500")
+@click.option("--rate-limit", type=int, default=0, help="ORS requests per minute")
+@click.option("--cache-ttl", type=float, default=300, help="Route cache TTL, 0 to disable")
+@click.option("--nearest-driver-ttl", type=float, default=0, help="Result reuse TTL")
+@click.option("--eta-mode", type=click.Choice(MODES), default="ors", help="ETA mode")
+@click.option("--arrival-board", "board", is_flag=True, help="Read precomputed arrival boards")
+@click.option("--fleet-store", "store", is_flag=True, help="Read drivers from the fleet store")
+@click.option("--seed", type=int, default=1, help="Random seed")
+def main(
+    routes_json,
+    drivers,
+    requests_count,
+    concurrency,
+    latency,
+    error_rate,
+    rate_limit,
+    cache_ttl,
+    nearest_driver_ttl,
+    eta_mode,
+    board,
+    store,
+    seed,
+):  # pylint: disable=too-many-arguments, too-many-locals
+    """Measure get_nearest_driver latency and throughput."""
+    server, url, counters = start_stub(
+        latency=latency, error_rate=error_rate, rate_limit=rate_limit, seed=seed
+    )
+    route_client.set_config(
+        "KEY",
+        base_url=url,
+        cache_ttl=cache_ttl,
+        directions_per_minute=0,
+        directions_per_day=0,
+        matrix_per_minute=0,
+        matrix_per_day=0,
+    )
+    passenger.nearest_driver_flight.set_config(ttl=nearest_driver_ttl)
+    estimator.set_config(mode=eta_mode)
+    route_data.load_from_json(routes_json)
+    route_data.load_geometries(route_client.get_ors_route_geometry)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    arrival_board.set_config(enabled=board)
+    fleet_store.set_config(enabled=store)
+    create_drivers(app.test_client(), drivers, seed)
+    with app.app_context():
+        arrival_board.flush()
+
+    rnd = random.Random(seed)
+    pairs = [
+        (stop, route) for route, info in route_data["routes"].items() for stop in info["stops"]
+    ]
+    queries = [rnd.choice(pairs) for _ in range(requests_count)]
+    local = threading.local()
+
+    def request(query):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        response = local.client.post(
+            "/passenger/get_nearest_driver", json={"stop": query[0], "route": query[1]}
+        )
+        return time.perf_counter() - started, response.json
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(request, queries))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    latencies = sorted(seconds * 1e3 for seconds, _ in results)
+    found = sum(1 for _, data in results if data.get("name"))
+    approximate = sum(1 for _, data in results if data.get("approximate"))
+    click.echo(
+        f"requests={requests_count} concurrency={concurrency} drivers={drivers} "
+        f"latency={latency} error_rate={error_rate} rate_limit={rate_limit} eta_mode={eta_mode} "
+        f"arrival_board={board} fleet_store={store}"
+    )
+    click.echo(
+        f"throughput={requests_count / elapsed:8.1f} req/s  "
+        f"mean={statistics.mean(latencies):8.1f} ms  p50={percentile(latencies, 0.5):8.1f} ms  "
+        f"p95={percentile(latencies, 0.95):8.1f} ms  p99={percentile(latencies, 0.99):8.1f} ms"
+    )
+    click.echo(f"found={found} approximate={approximate} ors={counters}")
+    click.echo(f"stats={route_client.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,113 @@
+import random
+import tracemalloc
+
+import haversine
+import numpy as np
+
+from transport_bot.api_service.distance import haversine_many_to_many, haversine_one_to_many
+from transport_bot.api_service.geo import GridIndex
+from transport_bot.api_service.polyline import RouteLine, decode, encode
+from transport_bot.api_service.trail import Trail, bearing
+
+
+def test_distance_kernel_matches_haversine():
+    rnd = random.Random(3)
+    points = [(rnd.uniform(-80, 80), rnd.uniform(-179, 179)) for _ in range(50)]
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+    one = haversine_one_to_many(51.5, -0.12, lats, lons)
+    assert one.dtype == np.float64 and one.shape == (50,)
+    assert np.allclose(one, [haversine.haversine((51.5, -0.12), p) for p in points])
+    many = haversine_many_to_many(lats[:5], lons[:5], lats, lons)
+    assert many.shape == (5, 50)
+    assert np.allclose(many, [[haversine.haversine(a, b) for b in points] for a in points[:5]])
+    assert np.allclose(np.diag(many[:, :5]), 0)
+
+
+def test_grid_index_matches_brute_force():
+    rnd = random.Random(7)
+    index = GridIndex(cell_km=0.3)
+    points = {}
+    for key in range(500):
+        points[key] = (51.45 + rnd.random() * 0.1, -0.2 + rnd.random() * 0.15)
+        index.insert(key, *points[key])
+    for key in range(0, 500, 5):
+        points[key] = (51.45 + rnd.random() * 0.1, -0.2 + rnd.random() * 0.15)
+        index.insert(key, *points[key])
+    for key in range(1, 500, 7):
+        del points[key]
+        index.remove(key)
+    assert len(index) == len(points)
+
+    for query in [(51.5, -0.12), (51.47, -0.19), (59.92, 30.34), (-33.86, 151.2)]:
+        expected = sorted((haversine.haversine(query, p), k) for k, p in points.items())
+        nearest = index.nearest(*query, count=10)
+        assert [k for _, k in nearest] == [k for _, k in expected[:10]]
+        within = index.within(*query, radius=2)
+        assert [k for _, k in within] == [k for d, k in expected if d <= 2]
+        assert [k for _, k in index.iter_nearest(*query)] == [k for _, k in expected]
+
+
+def test_grid_index_empty():
+    index = GridIndex()
+    assert index.nearest(51.5, -0.12, count=3) == []
+    index.insert("a", 51.5, -0.12)
+    index.remove("a")
+    assert "a" not in index
+    assert index.within(51.5, -0.12, radius=10) == []
+
+
+def test_polyline_encoding():
+    points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert encode(points) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert decode(encode(points)) == points
+
+
+def test_route_line_locate():
+    # Out along the meridian and back one street east
+    line = RouteLine([(51.50, -0.12), (51.51, -0.12), (51.51, -0.1185), (51.50, -0.1185)])
+    leg = haversine.haversine((51.50, -0.12), (51.51, -0.12))
+    assert np.isclose(line.length, 2 * leg + 0.104, atol=0.005)
+    offsets, distances = line.locate([51.505, 51.52], [-0.1201, -0.12])
+    assert np.allclose(offsets, [leg / 2, leg], atol=0.005)
+    assert np.allclose(distances, [0.007, leg], atol=0.005)
+    # The way back is taken once the way out is behind
+    offsets, _ = line.locate([51.505], [-0.1195], start=leg)
+    assert np.isclose(offsets[0], line.length - leg / 2, atol=0.005)
+
+
+def test_trail():
+    trail = Trail(size=3)
+    assert trail.velocity() is None
+    for i in range(5):
+        trail.append(100 + 10 * i, 51.5 + 0.001 * i, -0.12)
+    trail.append(130, 0, 0)
+    assert len(trail) == 3
+    assert [sample[0] for sample in trail.samples()] == [120, 130, 140]
+    heading, speed = trail.velocity()
+    assert heading == 0
+    # 0.002 degrees of latitude in 20 s
+    assert abs(speed - 0.002 * 111.195 / 20 * 3600) < 0.1
+    assert trail.approaching(51.6, -0.12)
+    assert not trail.approaching(51.4, -0.121)
+    assert abs(bearing(51.5, -0.12, 51.5, -0.1) - 90) < 0.1
+
+    standing = Trail()
+    standing.append(100, 51.5, -0.12)
+    standing.append(200, 51.5, -0.12)
+    assert standing.velocity() is None and standing.approaching(51.6, -0.12) is None
+
+
+def test_trail_memory():
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        trails = [Trail(8) for _ in range(100000)]
+        # Samples are preallocated, filling the trail takes no memory
+        for i, trail in enumerate(trails):
+            trail.append(i, 51.5 + i * 1e-6, -0.12)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    # 312 bytes per trail of 8 samples plus allocator overhead and list slot
+    assert used / len(trails) < 400
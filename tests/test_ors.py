@@ -0,0 +1,316 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pytest
+from werkzeug.serving import make_server
+
+from transport_bot import ors_stub
+from transport_bot.api_service import stats  # noqa: F401
+from transport_bot.api_service.breaker import CircuitBreaker
+from transport_bot.api_service.cache import RouteCache
+from transport_bot.api_service.eta import ROUTE, estimator
+from transport_bot.api_service.quota import PRIORITY_FORWARD, PRIORITY_REVERSE, QuotaManager
+from transport_bot.api_service.route import _RouteClient, route_client, route_data
+from transport_bot.api_service.schema import app
+
+SUMMARY = {"duration": 5, "distance": 2.76}
+
+
+def test_route_cache_quantization_and_lru():
+    cache = RouteCache(grid_meters=25, ttl=60, max_size=2)
+    key = cache.key(51.5001, -0.1201, 51.51, -0.13)
+    assert cache.get(key) is None
+    cache.put(key, SUMMARY)
+    # ~5 meters away falls into the same cell, ~100 meters does not
+    assert cache.get(cache.key(51.50013, -0.12012, 51.51, -0.13)) == SUMMARY
+    assert cache.get(cache.key(51.5010, -0.1201, 51.51, -0.13)) is None
+
+    cache.put("a", SUMMARY)
+    cache.get(key)
+    cache.put("b", SUMMARY)
+    assert cache.get("a") is None
+    assert cache.get(key) == SUMMARY
+    assert cache.stats()["memory_hits"] == 3
+    assert cache.stats()["size"] == 2
+
+
+def test_route_cache_ttl_and_disk_tier(tmp_path, monkeypatch):
+    path = str(tmp_path / "routes.sqlite")
+    cache = RouteCache(ttl=10, path=path)
+    cache.put("key", SUMMARY)
+
+    restarted = RouteCache(ttl=10, path=path)
+    assert restarted.get("key") == SUMMARY
+    assert restarted.get("key") == SUMMARY
+    assert restarted.stats() == {
+        "memory_hits": 1,
+        "disk_hits": 1,
+        "misses": 0,
+        "size": 1,
+        "hit_ratio": 1.0,
+    }
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert restarted.get("key") is None
+    assert RouteCache(ttl=10, path=path).get("key") is None
+
+
+def test_route_cache_purge(tmp_path, monkeypatch):
+    path = str(tmp_path / "routes.sqlite")
+    cache = RouteCache(ttl=10, path=path, purge_every=3)
+    cache.put("old", SUMMARY)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    cache.put("a", SUMMARY)
+
+    def keys():
+        with sqlite3.connect(path) as connection:
+            return sorted(key for (key,) in connection.execute("SELECT key FROM route_cache"))
+
+    assert keys() == ["a", "old"]
+    cache.put("b", SUMMARY)
+    assert keys() == ["a", "b"]
+
+
+def test_route_cache_memory_hit_during_disk_io(tmp_path):
+    cache = RouteCache(ttl=10, path=str(tmp_path / "routes.sqlite"))
+    cache.put("key", SUMMARY)
+    # A slow disk write in progress does not block memory hits
+    with cache._db_lock:
+        assert cache.get("key") == SUMMARY
+        assert cache.stats()["memory_hits"] == 1
+
+
+def test_stats_endpoint():
+    resp = app.test_client().get("/service/stats")
+    assert resp.status_code == 200
+    assert set(resp.json["ors"]["cache"]) >= {"memory_hits", "disk_hits", "misses"}
+
+
+class SlowDirections:
+    """ORS client stub: routes from slow origins take long."""
+
+    def __init__(self, slow_latitude, delay):
+        self.slow_latitude = slow_latitude
+        self.delay = delay
+        self.calls = 0
+        self.threads = set()
+
+    def directions(self, coords):
+        self.calls += 1
+        self.threads.add(threading.get_ident())
+        if coords[0][1] == self.slow_latitude:
+            time.sleep(self.delay)
+        return {"routes": [{"summary": {"duration": 60, "distance": 1000}}]}
+
+
+def test_fan_out_deadline():
+    client = _RouteClient()
+    client.set_config("KEY", use_matrix=False, workers=4, deadline=0.3)
+    client.client = SlowDirections(slow_latitude=51.3, delay=1)
+    sources = [(51.1, -0.1), (51.2, -0.1), (51.3, -0.1), (51.4, -0.1)]
+
+    started = time.monotonic()
+    result = client.get_ors_matrix_info(sources, [(51.5, -0.12)], client.new_deadline())
+    assert time.monotonic() - started < 0.9
+    summary = {"duration": 1, "distance": 1.0}
+    assert result == [[summary], [summary], [None], [summary]]
+    assert len(client.client.threads) > 1
+
+    # The late route is cached in background
+    time.sleep(1)
+    assert client.get_ors_matrix_info(sources, [(51.5, -0.12)]) == [[summary]] * 4
+    assert client.client.calls == 4
+
+
+def test_fan_out_queue_bound():
+    client = _RouteClient()
+    client.set_config("KEY", use_matrix=False, workers=1, deadline=0.05, breaker_latency=1)
+    assert client.client._timeout == 1
+    client.client = SlowDirections(slow_latitude=51.1, delay=0.3)
+    sources = [(51.1, -0.1)] + [(51.2 + i / 100, -0.1) for i in range(9)]
+
+    result = client.get_ors_matrix_info(sources, [(51.5, -0.12)], client.new_deadline())
+    assert result == [[None]] * 10
+    # One running and four waiting requests, the rest of the fan-out is shed
+    assert client.get_stats()["queue"] == {"pending": 5, "shed": 1}
+    time.sleep(0.5)
+    assert client.get_stats()["queue"] == {"pending": 0, "shed": 1}
+    assert client.client.calls == 5
+
+
+def test_circuit_breaker(monkeypatch):
+    breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5, latency=1, cooldown=10)
+    for success in (True, False, True):
+        assert breaker.allow()
+        breaker.record(success, 0.1)
+    assert breaker.state == "closed"
+    breaker.record(True, 1.5)  # slow call is a failure
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 22)
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.stats() == {"state": "closed", "trips": 2, "rejected": 2}
+
+
+def test_quota_priorities(monkeypatch):
+    quota = QuotaManager(per_minute=10, per_day=100, reserve=0.2)
+    for _ in range(8):
+        assert quota.acquire(PRIORITY_REVERSE)
+    # Reserve is kept for forward requests
+    assert not quota.acquire(PRIORITY_REVERSE)
+    assert quota.acquire(PRIORITY_FORWARD)
+    assert quota.acquire(PRIORITY_FORWARD)
+    assert not quota.acquire(PRIORITY_FORWARD)
+    stats = quota.stats()
+    assert stats["minute"] == {"capacity": 10, "available": 0}
+    assert stats["day"] == {"capacity": 100, "available": 90}
+    assert stats["granted"] == {"reverse": 8, "forward": 2}
+    assert stats["shed"] == {"reverse": 1, "forward": 1}
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 30)
+    assert quota.stats()["minute"]["available"] == 5
+    quota.exhausted()
+    assert not quota.acquire(PRIORITY_FORWARD)
+
+
+class OverQuotaMatrix:
+    """ORS client stub: matrix API refuses with 429."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def distance_matrix(self, *args, **kwargs):
+        from openrouteservice import exceptions
+
+        self.calls += 1
+        raise exceptions._OverQueryLimit(429, {})
+
+    def directions(self, coords):
+        self.calls += 1
+        return {"routes": [{"summary": {"duration": 60, "distance": 1000}}]}
+
+
+def test_route_client_quota():
+    client = _RouteClient()
+    client.set_config("KEY", deadline=None, matrix_per_minute=5, directions_per_minute=3)
+    client.client = OverQuotaMatrix()
+    sources = [(51.1, -0.1), (51.2, -0.1), (51.3, -0.1), (51.4, -0.1)]
+    result = client.get_ors_matrix_info(sources, [(51.5, -0.12)])
+    assert sum(1 for (summary,) in result if summary) == 3
+    assert client.client.calls == 4
+    # 429 drained the matrix budget: no more matrix requests this minute
+    assert client.get_stats()["quota"]["matrix"]["minute"]["available"] == 0
+    result = client.get_ors_matrix_info([(51.6, -0.1)], [(51.5, -0.12)], priority=PRIORITY_REVERSE)
+    assert result == [[None]]
+    assert client.client.calls == 4
+
+
+def test_ors_unreachable(monkeypatch):
+    client = _RouteClient()
+    client.set_config(
+        "KEY", base_url="http://127.0.0.1:9", deadline=None, breaker_cooldown=10, workers=2
+    )
+    sources = [(51.1, -0.1), (51.2, -0.1), (51.3, -0.1)]
+    for _ in range(2):
+        assert client.get_ors_matrix_info(sources, [(51.5, -0.12)]) == [[None]] * 3
+    stats = client.get_stats()
+    assert stats["breaker"]["state"] == "open"
+    assert stats["breaker"]["trips"] == 1
+    # Refused connections do not spend quota
+    assert stats["quota"]["matrix"]["minute"]["available"] == 40
+    assert stats["quota"]["directions"]["minute"]["available"] == 40
+
+    # A failed probe opens the breaker again
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert client.available()
+    assert client.get_ors_route_info(51.6, -0.1, 51.5, -0.12) is None
+    stats = client.get_stats()["breaker"]
+    assert (stats["state"], stats["trips"]) == ("open", 2)
+
+
+@pytest.fixture
+def ors_server():
+    servers = []
+
+    def start(**kwargs):
+        app = ors_stub.create_app(seed=1, **kwargs)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}", app.config["ORS_STUB_COUNTERS"]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_ors_stub(ors_server):
+    url, counters = ors_server(latency="uniform:0:0.01", detour_factor=1.0, average_speed=36)
+    client = _RouteClient()
+    client.set_config("KEY", base_url=url, deadline=None)
+    sources = [(51.50, -0.12), (51.51, -0.12)]
+    destinations = [(51.52, -0.12)]
+    assert client.get_ors_matrix_info(sources, destinations) == [
+        [{"duration": 4, "distance": 2.22}],
+        [{"duration": 2, "distance": 1.11}],
+    ]
+    assert client.get_ors_route_info(51.50, -0.12, 51.53, -0.12) == {
+        "duration": 6,
+        "distance": 3.34,
+    }
+    assert counters == {"requests": 2, "errors": 0, "rate_limited": 0}
+
+    url, counters = ors_server(error_rate=1.0)
+    client.set_config("KEY", base_url=url, deadline=None, use_matrix=False)
+    assert client.get_ors_route_info(51.50, -0.12, 51.53, -0.12) is None
+    assert counters["errors"] == 1
+
+    url, counters = ors_server(rate_limit=2)
+    client.set_config("KEY", base_url=url, deadline=None, use_matrix=False)
+    sources = [(51.50, -0.12), (51.51, -0.12), (51.515, -0.12)]
+    result = client.get_ors_matrix_info(sources, destinations)
+    assert sum(1 for (summary,) in result if summary) == 2
+    assert counters["rate_limited"] == 1
+
+
+def test_latency_distribution():
+    assert ors_stub.Latency("0.25").sample() == 0.25
+    assert 0.1 <= ors_stub.Latency("uniform:0.1:0.2").sample() <= 0.2
+    assert ors_stub.Latency("lognormal:0.1:0.5").sample() > 0
+    with pytest.raises(ValueError):
+        ors_stub.Latency("normal:1:2")
+
+
+def test_cold_segments_from_ors(ors_server):
+    url, counters = ors_server(detour_factor=1.0, average_speed=36)
+    route_data.load_from_json("./tests/routes.json")
+    route_client.set_config("KEY", base_url=url)
+    estimator.set_config(mode=ROUTE, ors_cold_segments=True)
+    try:
+        durations = estimator.segment_durations("13")
+        # 36 km/h is 10 m/s, the stand-in routes are straight lines
+        lengths = np.diff(route_data.route_stop_offsets["13"])
+        assert np.allclose(durations, lengths * 100, rtol=0.01)
+        assert counters["requests"] == 1
+        estimator.segment_durations("13")
+        assert counters["requests"] == 1
+    finally:
+        route_client.set_config("ORS_KEY")
+        estimator.set_config(mode=ROUTE, ors_cold_segments=False)
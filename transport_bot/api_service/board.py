@@ -0,0 +1,136 @@
+"""Arrival boards updated on driver changes."""
+
+import logging
+import threading
+import time
+
+from transport_bot.api_service import fleet
+from transport_bot.api_service.eta import estimator
+from transport_bot.api_service.hub import arrival_hub
+from transport_bot.api_service.route import route_data
+
+logger = logging.getLogger(__name__)
+
+
+class _ArrivalBoard:
+    """Next drivers arriving at every stop of every route.
+
+    Driver endpoints notify the board about changed routes, a background worker
+    rebuilds boards of these routes, so reading a board is a dictionary lookup.
+    Notifications arriving while a route is rebuilt are coalesced into one more
+    rebuild. All boards are also rebuilt every ``refresh`` seconds, so estimates
+    follow time of day and drivers that stopped reporting. Rebuilt boards are
+    published to arrival_hub subscribers.
+    """
+
+    def __init__(self):
+        self.size = 3
+        self.enabled = False
+        self._boards = {}
+        self._dirty = set()
+        self._condition = threading.Condition()
+        self._counters = {"notifications": 0, "rebuilds": 0}
+
+    def set_config(self, size=3, enabled=False):
+        """Set configuration and forget boards.
+
+        :param int size: Number of drivers on every board
+        :param bool enabled: True if passenger endpoints read boards
+        """
+        with self._condition:
+            self.size = size
+            self.enabled = enabled
+            self._boards = {}
+            self._dirty = set()
+
+    def notify(self, route):
+        """Mark route drivers as changed.
+
+        :param str route: Route key
+        """
+        if not self.enabled:
+            return
+        with self._condition:
+            self._dirty.add(route)
+            self._counters["notifications"] += 1
+            self._condition.notify()
+
+    def get(self, stop, route):
+        """Get board.
+
+        :param str stop: Stop key
+        :param str route: Route key
+        :return tuple: of dict(name, distance, duration) nearest first
+        """
+        return self._boards.get((stop, route), ())
+
+    def flush(self):
+        """Rebuild boards of changed routes now, call in application context."""
+        with self._condition:
+            routes, self._dirty = self._dirty, set()
+        self.rebuild(routes)
+
+    def rebuild(self, routes):
+        """Rebuild boards of routes, call in application context.
+
+        :param iterable routes: Route keys
+        """
+        for route in routes:
+            ids, latitudes, longitudes = fleet.find_route_columns(route)
+            durations = estimator.segment_durations(route)
+            selected = {
+                stop: estimator.nearest(
+                    route, stop, latitudes, longitudes, self.size, segment_durations=durations
+                )
+                for stop in route_data.route_stop_positions[route]
+            }
+            names = fleet.find_driver_names(
+                {ids[index] for arrivals in selected.values() for index, _ in arrivals}
+            )
+            for stop, arrivals in selected.items():
+                board = tuple(
+                    dict(summary, name=names[int(ids[index])])
+                    for index, summary in arrivals
+                    if int(ids[index]) in names
+                )
+                self._boards[(stop, route)] = board
+                arrival_hub.publish((stop, route), board)
+            with self._condition:
+                self._counters["rebuilds"] += 1
+
+    def start(self, app, refresh=30):
+        """Enable boards and run rebuilding worker in background thread.
+
+        :param flask.Flask app: Application to run the worker in its context
+        :param float refresh: Seconds between rebuilds of all boards
+        """
+        self.enabled = True
+
+        def run():
+            next_refresh = 0
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._dirty, timeout=max(next_refresh - time.monotonic(), 0)
+                    )
+                    if time.monotonic() >= next_refresh:
+                        self._dirty = set(route_data["routes"])
+                        next_refresh = time.monotonic() + refresh
+                try:
+                    with app.app_context():
+                        self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Arrival board error")
+
+        threading.Thread(target=run, name="arrival-board", daemon=True).start()
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: notifications, rebuilt routes, boards and pending routes
+        """
+        with self._condition:
+            return dict(self._counters, boards=len(self._boards), pending=len(self._dirty))
+
+
+arrival_board = _ArrivalBoard()
@@ -0,0 +1,110 @@
+"""Circuit breaker for external service calls."""
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stop calling a service that keeps failing or responding slowly.
+
+    Outcomes of the last ``window`` calls are kept. When at least ``min_calls``
+    of them are recorded and the share of failed calls reaches ``error_rate``,
+    the breaker opens and rejects calls for ``cooldown`` seconds. A call slower
+    than ``latency`` seconds counts as failed. After the cooldown one probe call
+    is let through (half-open): its success closes the breaker, its failure opens
+    it again.
+    """
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, latency=2.0, cooldown=30):
+        """Create closed breaker.
+
+        :param int window: Number of last calls to evaluate
+        :param int min_calls: Min number of calls in window to trip
+        :param float error_rate: Share of failed calls to trip
+        :param float latency: Seconds after which a call counts as failed
+        :param float cooldown: Seconds to stay open
+        """
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency = latency
+        self.cooldown = cooldown
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0
+        self._probe = False
+        self._counters = {"trips": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Get current state: closed, open or half_open."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Check whether a call may be made now.
+
+        :return bool: True if the call is allowed
+        """
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = HALF_OPEN
+                self._probe = False
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probe:
+                self._probe = True
+                return True
+            self._counters["rejected"] += 1
+            return False
+
+    def record(self, success, elapsed):
+        """Record call outcome.
+
+        :param bool success: False if the call failed
+        :param float elapsed: Call duration in seconds
+        """
+        failed = not success or elapsed > self.latency
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    logger.info("Circuit breaker closed")
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self._state == OPEN:
+                return
+            self._outcomes.append(failed)
+            if (
+                len(self._outcomes) >= self.min_calls
+                and sum(self._outcomes) / len(self._outcomes) >= self.error_rate
+            ):
+                self._open()
+
+    def stats(self):
+        """Get breaker state and counters.
+
+        :return dict: state, trips and rejected calls
+        """
+        state = self.state
+        with self._lock:
+            return dict(self._counters, state=state)
+
+    def _open(self):
+        logger.warning("Circuit breaker opened")
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._counters["trips"] += 1
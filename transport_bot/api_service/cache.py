@@ -0,0 +1,150 @@
+"""Cache of openrouteservice route summaries."""
+
+import collections
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+from transport_bot.api_service.geo import KM_PER_DEGREE
+
+logger = logging.getLogger(__name__)
+
+
+class RouteCache:
+    """Two-tier cache of route summaries keyed on quantized coordinates.
+
+    Origin and destination are snapped to a grid of ``grid_meters`` cells, so a
+    driver that barely moved reuses the summary computed for the previous position.
+    The first tier is an in-memory LRU, the optional second tier is a SQLite file
+    that survives restarts. Both tiers expire entries after ``ttl`` seconds,
+    expired rows are deleted from the file on start and every ``purge_every`` puts.
+    """
+
+    def __init__(self, grid_meters=25, ttl=300, max_size=10000, path=None, purge_every=1000):
+        """Create cache.
+
+        :param float grid_meters: Quantization grid cell size in meters
+        :param float ttl: Entry lifetime in seconds
+        :param int max_size: Max number of entries in memory
+        :param str path: SQLite file path for the persistent tier, None to disable
+        :param int purge_every: Puts between deletions of expired rows from the file
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.purge_every = purge_every
+        self._puts = 0
+        self._step = grid_meters / 1000 / KM_PER_DEGREE
+        self._memory = collections.OrderedDict()
+        # Guards the memory tier and counters, the disk tier has its own lock,
+        # so memory hits do not wait for disk reads and writes
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS route_cache "
+                "(key TEXT PRIMARY KEY, duration REAL, distance REAL, expires_at REAL)"
+            )
+            self._purge()
+
+    def key(self, from_latitude, from_longitude, to_latitude, to_longitude):
+        """Get cache key for route.
+
+        :param float from_latitude: origin latitude
+        :param float from_longitude: origin longitude
+        :param float to_latitude: destination latitude
+        :param float to_longitude: destination longitude
+        :return str: quantized key
+        """
+        return "{},{}:{},{}".format(
+            *self._quantize(from_latitude, from_longitude),
+            *self._quantize(to_latitude, to_longitude),
+        )
+
+    def get(self, key):
+        """Get route summary.
+
+        :param str key: Cache key
+        :return dict(duration=float, distance=float) or None on miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return dict(entry[1])
+                del self._memory[key]
+        row = None
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT duration, distance, expires_at FROM route_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+        with self._lock:
+            if row is not None and row[2] > now:
+                summary = {"duration": row[0], "distance": row[1]}
+                self._remember(key, summary, row[2])
+                self._counters["disk_hits"] += 1
+                return dict(summary)
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key, summary):
+        """Store route summary.
+
+        :param str key: Cache key
+        :param dict summary: Route summary with duration and distance
+        """
+        expires_at = time.time() + self.ttl
+        summary = {"duration": summary["duration"], "distance": summary["distance"]}
+        with self._lock:
+            self._remember(key, summary, expires_at)
+        if self._db is not None:
+            with self._db_lock:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO route_cache VALUES (?, ?, ?, ?)",
+                        (key, summary["duration"], summary["distance"], expires_at),
+                    )
+                    self._puts += 1
+                    if self._puts % self.purge_every == 0:
+                        self._purge()
+                    else:
+                        self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error("Route cache write error: %s", e)
+
+    def stats(self):
+        """Get hit/miss counters.
+
+        :return dict: memory_hits, disk_hits, misses, hit_ratio and size
+        """
+        with self._lock:
+            result = dict(self._counters, size=len(self._memory))
+        lookups = result["memory_hits"] + result["disk_hits"] + result["misses"]
+        hits = result["memory_hits"] + result["disk_hits"]
+        result["hit_ratio"] = round(hits / lookups, 4) if lookups else 0
+        return result
+
+    def _quantize(self, latitude, longitude):
+        row = math.floor(latitude / self._step)
+        # Keep cells roughly square: longitude step widens with latitude of the row.
+        lon_step = self._step / max(math.cos(math.radians(row * self._step)), 1e-6)
+        return row, math.floor(longitude / lon_step)
+
+    def _purge(self):
+        self._db.execute("DELETE FROM route_cache WHERE expires_at < ?", (time.time(),))
+        self._db.commit()
+
+    def _remember(self, key, summary, expires_at):
+        self._memory[key] = (expires_at, summary)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
@@ -13,6 +13,7 @@ logger = logging.getLogger(__name__)
 
 HEADERS = {"Content-Type": "application/json"}
 use_body = functools.partial(flaskparser.use_args, location="json", error_status_code=400)
+use_query = functools.partial(flaskparser.use_args, location="query", error_status_code=400)
 
 
 def resp(status=200, data=None):
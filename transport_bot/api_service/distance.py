@@ -0,0 +1,45 @@
+"""Vectorized great-circle distances."""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_one_to_many(latitude, longitude, latitudes, longitudes):
+    """Get distances from one point to many points.
+
+    :param float latitude: Point latitude
+    :param float longitude: Point longitude
+    :param array-like latitudes: Latitudes of other points
+    :param array-like longitudes: Longitudes of other points
+    :return numpy.ndarray: float64 distances in km, one per other point
+    """
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    lat0 = np.radians(latitude)
+    lon0 = np.radians(longitude)
+    d = (
+        np.sin((lat - lat0) * 0.5) ** 2
+        + np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) * 0.5) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
+
+
+def haversine_many_to_many(latitudes1, longitudes1, latitudes2, longitudes2):
+    """Get distances from every point of the first set to every point of the second set.
+
+    :param array-like latitudes1: Latitudes of the first set
+    :param array-like longitudes1: Longitudes of the first set
+    :param array-like latitudes2: Latitudes of the second set
+    :param array-like longitudes2: Longitudes of the second set
+    :return numpy.ndarray: float64 distances in km with shape (len(first), len(second))
+    """
+    lat1 = np.radians(np.asarray(latitudes1, dtype=np.float64))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(longitudes1, dtype=np.float64))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(latitudes2, dtype=np.float64))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(longitudes2, dtype=np.float64))[np.newaxis, :]
+    d = (
+        np.sin((lat2 - lat1) * 0.5) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
@@ -1,14 +1,31 @@
 """Driver http api."""
 
-import haversine
-from flask import abort
+import datetime
+import json
+import struct
+
+from flask import abort, request
+from marshmallow import EXCLUDE, Schema, ValidationError
 from webargs import fields, validate
 
-from transport_bot.api_service import query
+from transport_bot.api_service import fleet, query
+from transport_bot.api_service.board import arrival_board
 from transport_bot.api_service.common import conflict, resp, use_body
+from transport_bot.api_service.fleet import fleet_store
 from transport_bot.api_service.route import route_data
 from transport_bot.api_service.schema import app, db
 
+BULK_LOCATIONS_MAX_COUNT = 10000
+# Max seconds a bulk location timestamp may be ahead of the server clock
+BULK_LOCATIONS_MAX_SKEW = 60
+# Stored locations are checked as strictly as by the DriverTable constraints
+STORED_LATITUDE = validate.Range(min=-90, max=90, min_inclusive=False, max_inclusive=False)
+STORED_LONGITUDE = validate.Range(min=-180, max=180, min_inclusive=False, max_inclusive=False)
+# Binary body of fast_location: latitude and longitude as little-endian doubles
+LOCATION_STRUCT = struct.Struct("<2d")
+# Body of empty json responses, as made by jsonify
+EMPTY_JSON = b"{}\n"
+
 
 class RouteValidate(validate.Validator):
     """Route validator."""
@@ -20,12 +37,14 @@ class RouteValidate(validate.Validator):
         raise validate.ValidationError(message=f"No route: {route}")
 
 
-def lock_driver(messenger_id):
-    """Db locked driver."""
-    driver = query.find_driver(messenger_id, for_update=True)
-    if not driver:
-        abort(404, f"No found driver {messenger_id}")
-    return driver
+_bulk_location_schema = Schema.from_dict(
+    {
+        "messenger_id": fields.Integer(required=True, strict=True),
+        "latitude": fields.Float(required=True, validate=[STORED_LATITUDE]),
+        "longitude": fields.Float(required=True, validate=[STORED_LONGITUDE]),
+        "timestamp": fields.Float(required=True, validate=[validate.Range(min=0)]),
+    }
+)(many=True, unknown=EXCLUDE)
 
 
 @app.route("/driver/get_routes", methods=["POST"])
@@ -41,19 +60,8 @@ def get_routes(body):
     :param dict body: Contains latitude and longitude
     :return Flask.Response: status=200
     """
-    result = []
-    driver_location = (body["latitude"], body["longitude"])
-    for key, data in route_data["routes"].items():
-        min_distance = 0
-
-        for stop_key in data["stops"]:
-            stop_location = route_data["stops"][stop_key]["location"]
-            stop_location = (stop_location["lat"], stop_location["lon"])
-            distance = haversine.haversine(driver_location, stop_location)
-            if min_distance == 0 or min_distance > distance:
-                min_distance = distance
-        result.append((min_distance, key, data))
-    data = [{"key": r[1], "name": r[2]["name"]} for r in sorted(result)]
+    distances = route_data.route_distances(body["latitude"], body["longitude"])
+    data = [{"key": key, "name": route_data["routes"][key]["name"]} for _, key in distances]
     return resp(data=data)
 
 
@@ -64,7 +72,7 @@ def get_driver(messenger_id):
     :param int messenger_id: Passenger telegram messenger_id
     :return Flask.Response: status=200 and json data with driver details
     """
-    driver = query.find_driver(messenger_id, for_update=False)
+    driver = fleet.find_driver(messenger_id)
     if driver:
         result = resp(
             data={
@@ -76,6 +84,7 @@ def get_driver(messenger_id):
                 "route": driver.route,
                 "state": driver.state,
                 "last_update": driver.last_update,
+                "version": driver.version,
             }
         )
     else:
@@ -88,8 +97,8 @@ def get_driver(messenger_id):
     {
         "phone": fields.Str(required=True),
         "name": fields.Str(required=True),
-        "latitude": fields.Float(required=True, validate=[validate.Range(min=-90, max=90)]),
-        "longitude": fields.Float(required=True, validate=[validate.Range(min=-180, max=180)]),
+        "latitude": fields.Float(required=True, validate=[STORED_LATITUDE]),
+        "longitude": fields.Float(required=True, validate=[STORED_LONGITUDE]),
         "route": fields.Str(required=True, validate=[RouteValidate()]),
     }
 )
@@ -101,12 +110,28 @@ def post_driver(body, messenger_id):
     :return Flask.Response: status=200 on success,
                             status=409 on duplicate
     """
-    driver = query.find_driver(messenger_id, for_update=False)
+    driver = fleet.find_driver(messenger_id)
+    routes = {body["route"]}
     if driver:
         if body["phone"] != driver.phone:
             return conflict("Duplicate phone")
-        query.update_driver_location(messenger_id, body["latitude"], body["longitude"])
-        query.update_driver_route(messenger_id, body["route"])
+        routes.add(driver.route)
+        if fleet_store.enabled:
+            fleet_store.update_driver(
+                messenger_id,
+                latitude=body["latitude"],
+                longitude=body["longitude"],
+                route=body["route"],
+            )
+        elif not query.update_driver(
+            messenger_id,
+            version=driver.version,
+            latitude=body["latitude"],
+            longitude=body["longitude"],
+            route=body["route"],
+        ):
+            # Changed since the phone was checked
+            return conflict("Driver changed, try again")
     else:
         query.add_driver(
             messenger_id,
@@ -117,14 +142,25 @@ def post_driver(body, messenger_id):
             body["route"],
         )
     db.session.commit()
+    if not driver and fleet_store.enabled:
+        fleet_store.add_driver(
+            messenger_id,
+            body["phone"],
+            body["name"],
+            body["latitude"],
+            body["longitude"],
+            body["route"],
+        )
+    for route in routes:
+        arrival_board.notify(route)
     return resp()
 
 
 @app.route("/driver/<int:messenger_id>/location", methods=["PUT"])
 @use_body(
     {
-        "latitude": fields.Float(required=True, validate=[validate.Range(min=-90, max=90)]),
-        "longitude": fields.Float(required=True, validate=[validate.Range(min=-180, max=180)]),
+        "latitude": fields.Float(required=True, validate=[STORED_LATITUDE]),
+        "longitude": fields.Float(required=True, validate=[STORED_LONGITUDE]),
     }
 )
 def put_driver_location(body, messenger_id):
@@ -135,12 +171,129 @@ def put_driver_location(body, messenger_id):
     :return Flask.Response: status=200 on success,
                             status=404 on not found
     """
-    lock_driver(messenger_id)
-    query.update_driver_location(messenger_id, body["latitude"], body["longitude"])
+    if fleet_store.enabled:
+        driver = fleet_store.update_location(messenger_id, body["latitude"], body["longitude"])
+        if not driver:
+            abort(404, f"No found driver {messenger_id}")
+        arrival_board.notify(driver.route)
+        return resp()
+
+    driver = query.update_driver_location(messenger_id, body["latitude"], body["longitude"])
+    if not driver:
+        abort(404, f"No found driver {messenger_id}")
+    if driver.state == "connected":
+        query.add_location_history(
+            messenger_id,
+            driver.route,
+            body["latitude"],
+            body["longitude"],
+            datetime.datetime.now(),
+        )
     db.session.commit()
+    arrival_board.notify(driver.route)
     return resp()
 
 
+@app.route("/driver/<int:messenger_id>/fast_location", methods=["PUT"])
+def put_driver_fast_location(messenger_id):
+    """Update driver location, the lean variant of put_driver_location.
+
+    The body is json dict(latitude, longitude) or, with Content-Type
+    application/octet-stream, LOCATION_STRUCT: 16 bytes of latitude and
+    longitude. The body is checked without webargs and the response is not
+    logged.
+
+    :param int messenger_id: driver identifier in telegram
+    :return Flask.Response: status=200 on success,
+                            status=400 on invalid location,
+                            status=404 on not found
+    """
+    data = request.get_data(cache=False)
+    if request.mimetype == "application/octet-stream":
+        if len(data) != LOCATION_STRUCT.size:
+            return resp(400, {"detail": f"Expected {LOCATION_STRUCT.size} bytes"})
+        latitude, longitude = LOCATION_STRUCT.unpack(data)
+    else:
+        try:
+            body = json.loads(data)
+            latitude, longitude = body["latitude"], body["longitude"]
+        except (ValueError, TypeError, KeyError):
+            return resp(400, {"detail": "Expected json with latitude and longitude"})
+    if not _is_coordinate(latitude, 90) or not _is_coordinate(longitude, 180):
+        return resp(400, {"detail": "Invalid latitude or longitude"})
+
+    if fleet_store.enabled:
+        driver = fleet_store.update_location(messenger_id, latitude, longitude)
+        if not driver:
+            abort(404, f"No found driver {messenger_id}")
+    else:
+        driver = query.update_driver_location(messenger_id, latitude, longitude)
+        if not driver:
+            abort(404, f"No found driver {messenger_id}")
+        if driver.state == "connected":
+            query.add_location_history(
+                messenger_id, driver.route, latitude, longitude, datetime.datetime.now()
+            )
+        db.session.commit()
+    arrival_board.notify(driver.route)
+    return app.response_class(EMPTY_JSON, mimetype="application/json")
+
+
+@app.route("/driver/locations", methods=["POST"])
+def post_driver_locations():
+    """Update locations of many drivers at once.
+
+    The body is a json array or newline delimited json (Content-Type
+    application/x-ndjson) of dict(messenger_id, latitude, longitude, timestamp),
+    where timestamp is unix time in seconds of the location. The batch is
+    validated as a whole and applied in one transaction, a location not newer
+    than the previous one of its driver is dropped.
+
+    :return Flask.Response: status=200 and json with format dict(accepted, dropped, unknown)
+                            with numbers of locations, status=400 on invalid batch
+    """
+    if request.mimetype == "application/x-ndjson":
+        try:
+            items = [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+        except ValueError as error:
+            return resp(400, {"detail": f"Invalid json line: {error}"})
+    else:
+        items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return resp(400, {"detail": "Expected array of locations"})
+    if len(items) > BULK_LOCATIONS_MAX_COUNT:
+        return resp(400, {"detail": f"More than {BULK_LOCATIONS_MAX_COUNT} locations"})
+    try:
+        locations = _bulk_location_schema.load(items)
+    except ValidationError as error:
+        return resp(400, {"detail": "Invalid locations", "errors": error.messages})
+
+    latest_allowed = datetime.datetime.now() + datetime.timedelta(seconds=BULK_LOCATIONS_MAX_SKEW)
+    skewed = 0
+    for location in locations:
+        try:
+            location["timestamp"] = datetime.datetime.fromtimestamp(location["timestamp"])
+        except (OverflowError, OSError, ValueError):
+            # Too far in the future to be a time
+            location["timestamp"] = None
+        if location["timestamp"] is None or location["timestamp"] > latest_allowed:
+            skewed += 1
+    if skewed:
+        locations = [
+            location
+            for location in locations
+            if location["timestamp"] is not None and location["timestamp"] <= latest_allowed
+        ]
+
+    if fleet_store.enabled:
+        accepted, dropped, unknown, routes = fleet_store.update_locations(locations)
+    else:
+        accepted, dropped, unknown, routes = _update_locations(locations)
+    for route in routes:
+        arrival_board.notify(route)
+    return resp(data={"accepted": accepted, "dropped": dropped + skewed, "unknown": unknown})
+
+
 @app.route("/driver/<int:messenger_id>/start", methods=["POST"])
 def post_driver_start(messenger_id):
     """Update driver state on connected.
@@ -149,10 +302,7 @@ def post_driver_start(messenger_id):
     :return Flask.Response: status=200 on success,
                             status=404 on not found
     """
-    lock_driver(messenger_id)
-    query.update_driver_state(messenger_id, state="connected")
-    db.session.commit()
-    return resp()
+    return _set_driver_state(messenger_id, "connected")
 
 
 @app.route("/driver/<int:messenger_id>/stop", methods=["POST"])
@@ -163,7 +313,54 @@ def post_driver_stop(messenger_id):
     :return Flask.Response: status=200 on success,
                             status=404 on not found
     """
-    lock_driver(messenger_id)
-    query.update_driver_state(messenger_id, state="disabled")
+    return _set_driver_state(messenger_id, "disabled")
+
+
+def _update_locations(locations):
+    messenger_ids = {location["messenger_id"] for location in locations}
+    drivers = {driver.messenger_id: driver for driver in query.find_drivers_by_ids(messenger_ids)}
+    accepted, dropped, unknown = fleet.newer_locations(locations, drivers)
+    latest = {location["messenger_id"]: location for location in accepted}
+    rows = [
+        {
+            "messenger_id": messenger_id,
+            "latitude": location["latitude"],
+            "longitude": location["longitude"],
+            "last_update": location["timestamp"],
+        }
+        for messenger_id, location in latest.items()
+    ]
+    if rows:
+        query.update_driver_locations(rows)
+    history = [
+        dict(location, route=drivers[location["messenger_id"]].route)
+        for location in accepted
+        if drivers[location["messenger_id"]].state in ("connected", "stale")
+    ]
+    if history:
+        query.add_location_histories(history)
+    routes = {drivers[messenger_id].route for messenger_id in latest}
     db.session.commit()
+    return len(accepted), dropped, unknown, routes
+
+
+def _is_coordinate(value, limit):
+    # json true is a number in Python, NaN fails the range check,
+    # the limits are excluded like by STORED_LATITUDE and STORED_LONGITUDE
+    return (
+        isinstance(value, (int, float)) and not isinstance(value, bool) and -limit < value < limit
+    )
+
+
+def _set_driver_state(messenger_id, state):
+    if fleet_store.enabled:
+        driver = fleet_store.update_driver(messenger_id, state=state)
+        if not driver:
+            abort(404, f"No found driver {messenger_id}")
+    else:
+        driver = query.update_driver(messenger_id, state=state)
+        if not driver:
+            abort(404, f"No found driver {messenger_id}")
+        db.session.commit()
+    arrival_board.notify(driver.route)
     return resp()
@@ -0,0 +1,199 @@
+"""Driver arrival estimates."""
+
+import threading
+import time
+
+import numpy as np
+
+from transport_bot.api_service.distance import haversine_one_to_many
+from transport_bot.api_service.history import segment_model
+from transport_bot.api_service.route import AT_STOP_DISTANCE, route_client, route_data
+
+# Distance and duration along the route line, no ORS calls
+ROUTE = "route"
+# ORS routes from drivers to the stop and back
+ORS = "ors"
+MODES = (ROUTE, ORS)
+
+# Max distance in km from driver to the stop
+MAX_RADIUS = 4
+
+# Seconds before requesting failed ORS segments again
+ORS_SEGMENTS_RETRY = 60
+
+
+class _Estimator:
+    """Estimate driver arrival at a stop."""
+
+    def __init__(self):
+        self.mode = ROUTE
+        self.off_route = 0.3
+        self.ors_cold_segments = True
+        self._ors_segments = {}
+        self._lock = threading.Lock()
+
+    def set_config(self, mode=ROUTE, off_route=0.3, ors_cold_segments=True):
+        """Set configuration.
+
+        :param str mode: "route" to measure distance along the route line,
+                         "ors" to request routes from ORS
+        :param float off_route: Max distance in km from driver to the route line,
+                                farther drivers are not on the route
+        :param bool ors_cold_segments: Request from ORS travel times of segments
+                                       that are neither learned nor precomputed
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown ETA mode: {mode}")
+        self.mode = mode
+        self.off_route = off_route
+        self.ors_cold_segments = ors_cold_segments
+        with self._lock:
+            self._ors_segments = {}
+
+    def along_route(self, route, stop, latitudes, longitudes, segment_durations=None):
+        """Estimate arrival of drivers moving along the route.
+
+        Duration is the sum of segment travel times, see segment_durations.
+        Distance along straight lines between stops is multiplied by detour
+        factor, see approximate.
+
+        :param str route: Route key
+        :param str stop: Stop key of the route
+        :param numpy.ndarray latitudes: Driver latitudes
+        :param numpy.ndarray longitudes: Driver longitudes
+        :param segment_durations: Result of segment_durations for the route, computed if None
+        :return tuple: (distances, durations) arrays in km and seconds, distance is
+                       inf for drivers that are off route or have passed the stop
+        """
+        if not len(latitudes):
+            return np.empty(0), np.empty(0)
+        distances, durations = route_data.along_route(
+            route,
+            stop,
+            latitudes,
+            longitudes,
+            self.off_route,
+            self.segment_durations(route) if segment_durations is None else segment_durations,
+        )
+        if self.approximate(route):
+            distances = distances * route_client.detour_factor
+        return distances, durations
+
+    def nearest(
+        self,
+        route,
+        stop,
+        latitudes,
+        longitudes,
+        count,
+        by_distance=False,
+        segment_durations=None,
+    ):  # pylint: disable=too-many-arguments
+        """Select drivers of the route arriving at the stop first.
+
+        Drivers farther than MAX_RADIUS from the stop in a straight line can not
+        be within MAX_RADIUS along the route, they are skipped before projecting
+        drivers onto the route line.
+
+        :param str route: Route key
+        :param str stop: Stop key of the route
+        :param numpy.ndarray latitudes: Driver latitudes
+        :param numpy.ndarray longitudes: Driver longitudes
+        :param int count: Max number of drivers
+        :param bool by_distance: Order by distance, otherwise by duration and distance
+        :param segment_durations: Result of segment_durations for the route, computed if None
+        :return list: of tuple(driver index, summary) first arriving first, where summary
+                      is dict(duration=int, distance=float) and approximate=True
+                      for approximate distance
+        """
+        location = route_data["stops"][stop]["location"]
+        straight = haversine_one_to_many(location["lat"], location["lon"], latitudes, longitudes)
+        near = np.flatnonzero(straight <= MAX_RADIUS + self.off_route + AT_STOP_DISTANCE)
+        distances, durations = self.along_route(
+            route, stop, latitudes[near], longitudes[near], segment_durations
+        )
+        within = np.flatnonzero(distances <= MAX_RADIUS)
+        kilometers = np.round(distances[within], 2)
+        minutes = np.round(durations[within] / 60)
+        order = np.lexsort((minutes, kilometers) if by_distance else (kilometers, minutes))
+        return [
+            (int(near[within[i]]), self.summary(route, distances[within[i]], durations[within[i]]))
+            for i in order[:count]
+        ]
+
+    def summary(self, route, distance, duration):
+        """Make arrival summary.
+
+        :param str route: Route key
+        :param float distance: Km along the route
+        :param float duration: Seconds
+        :return dict: duration in minutes, distance in km and approximate=True
+                      for approximate distance
+        """
+        result = {"duration": round(float(duration) / 60), "distance": round(float(distance), 2)}
+        if self.approximate(route):
+            result["approximate"] = True
+        return result
+
+    @staticmethod
+    def approximate(route):
+        """Check whether distances along the route are approximate.
+
+        They are when the route line is made of straight lines between stops and
+        there are no precomputed segments.
+
+        :param str route: Route key
+        :return bool: True if approximate
+        """
+        return route_data.route_lines[route].approximate and route not in route_data.route_segments
+
+    def segment_durations(self, route):
+        """Get travel times of route segments between consecutive stops.
+
+        A segment time is learned from location history for the current time of
+        day, or precomputed, or requested from ORS, or the segment length at
+        average speed, whichever comes first.
+
+        :param str route: Route key
+        :return numpy.ndarray: seconds per segment
+        """
+        durations = segment_model.durations(route)
+        if route in route_data.route_segments:
+            precomputed = np.diff(route_data.route_segments[route][0])
+            durations = np.where(np.isnan(durations), precomputed, durations)
+        if np.isnan(durations).any() and self.ors_cold_segments:
+            durations = np.where(np.isnan(durations), self._ors_durations(route), durations)
+        cold = np.isnan(durations)
+        if cold.any():
+            lengths = np.diff(route_data.route_stop_offsets[route])
+            if route_data.route_lines[route].approximate:
+                lengths = lengths * route_client.detour_factor
+            durations = np.where(cold, lengths / route_client.average_speed * 3600, durations)
+        return durations
+
+    def _ors_durations(self, route):
+        """Get segment times requested from ORS once per route, nan if not received."""
+        pairs = tuple(route_data.consecutive_pairs(route))
+        with self._lock:
+            known = self._ors_segments.get((route, pairs))
+        if known is not None and (
+            not np.isnan(known[1]).any() or time.monotonic() - known[0] < ORS_SEGMENTS_RETRY
+        ):
+            return known[1]
+        durations = np.full(len(pairs), np.nan)
+        if route_client.available():
+            points = [
+                tuple(route_data["stops"][stop]["location"][axis] for axis in ("lat", "lon"))
+                for pair in pairs
+                for stop in pair
+            ]
+            segments = route_client.get_ors_segments(list(zip(points[::2], points[1::2])))
+            for i, segment in enumerate(segments):
+                if segment is not None:
+                    durations[i] = segment[0]
+        with self._lock:
+            self._ors_segments[(route, pairs)] = (time.monotonic(), durations)
+        return durations
+
+
+estimator = _Estimator()
@@ -0,0 +1,637 @@
+"""In-memory live fleet with write-behind persistence."""
+
+import collections
+import datetime
+import logging
+import threading
+
+import numpy as np
+from sqlalchemy import exc
+
+from transport_bot.api_service import query
+from transport_bot.api_service.distance import haversine_one_to_many
+from transport_bot.api_service.geo import GridIndex
+from transport_bot.api_service.schema import db
+from transport_bot.api_service.trail import Trail
+
+logger = logging.getLogger(__name__)
+
+# Fields written to the database on flush
+FLUSHED_FIELDS = ("latitude", "longitude", "route", "state", "last_update", "version")
+# Max number of history locations waiting for flush
+HISTORY_LIMIT = 100000
+
+
+class LiveDriver:
+    """Driver kept in memory, has the attributes of DriverTable."""
+
+    __slots__ = (
+        "messenger_id",
+        "phone",
+        "name",
+        "latitude",
+        "longitude",
+        "route",
+        "state",
+        "last_update",
+        "version",
+    )
+
+    def __init__(
+        self, messenger_id, phone, name, latitude, longitude, route, state, last_update, version
+    ):
+        """Create driver."""
+        self.messenger_id = messenger_id
+        self.phone = phone
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.route = route
+        self.state = state
+        self.last_update = last_update
+        self.version = version
+
+    @classmethod
+    def from_row(cls, row):
+        """Create from DriverTable row."""
+        return cls(
+            row.messenger_id,
+            row.phone,
+            row.name,
+            row.latitude,
+            row.longitude,
+            row.route,
+            row.state,
+            row.last_update,
+            row.version,
+        )
+
+
+class RouteColumns:
+    """Connected drivers of a route as parallel arrays.
+
+    The first ``size`` items of ``ids``, ``latitudes`` and ``longitudes`` are the
+    drivers. Arrays grow by doubling and a removed driver is replaced by the last
+    one, so adding, moving and removing a driver take constant time.
+    """
+
+    __slots__ = ("ids", "latitudes", "longitudes", "size", "_positions")
+
+    def __init__(self, capacity=16):
+        """Create empty columns."""
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.latitudes = np.zeros(capacity, dtype=np.float64)
+        self.longitudes = np.zeros(capacity, dtype=np.float64)
+        self.size = 0
+        self._positions = {}
+
+    def put(self, messenger_id, latitude, longitude):
+        """Add driver or move it to the new location."""
+        position = self._positions.get(messenger_id)
+        if position is None:
+            if self.size == len(self.ids):
+                capacity = 2 * len(self.ids)
+                self.ids = np.resize(self.ids, capacity)
+                self.latitudes = np.resize(self.latitudes, capacity)
+                self.longitudes = np.resize(self.longitudes, capacity)
+            position = self._positions[messenger_id] = self.size
+            self.ids[position] = messenger_id
+            self.size += 1
+        self.latitudes[position] = latitude
+        self.longitudes[position] = longitude
+
+    def remove(self, messenger_id):
+        """Remove driver if present."""
+        position = self._positions.pop(messenger_id, None)
+        if position is None:
+            return
+        last = self.size - 1
+        if position != last:
+            moved = int(self.ids[last])
+            self.ids[position] = moved
+            self.latitudes[position] = self.latitudes[last]
+            self.longitudes[position] = self.longitudes[last]
+            self._positions[moved] = position
+        self.size = last
+
+    def snapshot(self):
+        """Copy drivers.
+
+        :return tuple: (ids, latitudes, longitudes) arrays
+        """
+        return (
+            self.ids[: self.size].copy(),
+            self.latitudes[: self.size].copy(),
+            self.longitudes[: self.size].copy(),
+        )
+
+
+class _FleetStore:
+    """Authoritative in-memory copy of the driver table.
+
+    When enabled, the store serves all driver reads, connected drivers are also
+    kept as RouteColumns per route and in a GridIndex of their locations, and
+    their last reported locations are kept in a Trail. Location, route and state changes are
+    applied in memory only and the changed drivers are marked dirty, ``flush``
+    writes the last values of dirty drivers to the database with one bulk UPDATE,
+    so a driver reporting its location many times between flushes costs one row
+    update. Location history is buffered and inserted in bulk by
+    the same flush; while flushes fail, the oldest locations over
+    ``history_limit`` are dropped. New drivers are inserted at once, so the
+    database still checks phone uniqueness.
+    Changes made after the last flush are lost if the process dies.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._drivers = {}
+        # route -> RouteColumns of connected drivers
+        self._columns = {}
+        # messenger_id -> location of connected drivers
+        self._grid = GridIndex()
+        self.grid_cell = 0.5
+        # messenger_id -> Trail of connected drivers
+        self._trails = {}
+        # messenger_ids of connected drivers, least recently updated first
+        self._recent = collections.OrderedDict()
+        self.trail_size = 8
+        self._dirty = set()
+        self._history = collections.deque(maxlen=HISTORY_LIMIT)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._counters = {
+            "writes": 0,
+            "flushes": 0,
+            "flushed_drivers": 0,
+            "flushed_history": 0,
+            "dropped_history": 0,
+        }
+
+    def set_config(self, enabled=False, grid_cell=0.5, trail_size=8, history_limit=HISTORY_LIMIT):
+        """Set configuration and forget drivers.
+
+        :param bool enabled: True if driver endpoints use the store
+        :param float grid_cell: Cell size in km of the driver location index
+        :param int trail_size: Number of last locations kept per driver
+        :param int history_limit: Max number of history locations waiting for flush
+        """
+        with self._lock:
+            self.enabled = enabled
+            self.grid_cell = grid_cell
+            self.trail_size = trail_size
+            self._trails = {}
+            self._recent = collections.OrderedDict()
+            self._drivers = {}
+            self._columns = {}
+            self._grid = GridIndex(grid_cell)
+            self._dirty = set()
+            self._history = collections.deque(maxlen=history_limit)
+
+    def load(self):
+        """Load all drivers from the database, call in application context."""
+        drivers = {row.messenger_id: LiveDriver.from_row(row) for row in query.find_drivers()}
+        with self._lock:
+            self._drivers = drivers
+            self._columns = {}
+            self._grid = GridIndex(self.grid_cell)
+            self._trails = {}
+            self._recent = collections.OrderedDict()
+            for driver in sorted(drivers.values(), key=lambda driver: driver.last_update):
+                self._index(driver)
+
+    def find_driver(self, messenger_id):
+        """Get driver.
+
+        :param int messenger_id: Driver identifier in telegram
+        :return LiveDriver: or None
+        """
+        return self._drivers.get(messenger_id)
+
+    def find_route_columns(self, route):
+        """Get connected drivers on the route as arrays.
+
+        :param str route: Route key
+        :return tuple: (ids, latitudes, longitudes) arrays
+        """
+        with self._lock:
+            columns = self._columns.get(route)
+            return columns.snapshot() if columns else _empty_columns()
+
+    def find_nearby_drivers(self, latitude, longitude, count, radius):
+        """Get connected drivers of all routes nearest to the location.
+
+        :param float latitude: Latitude
+        :param float longitude: Longitude
+        :param int count: Max number of drivers
+        :param float radius: Max distance in km
+        :return list: of tuple(distance, LiveDriver) nearest first
+        """
+        with self._lock:
+            return [
+                (distance, self._drivers[messenger_id])
+                for distance, messenger_id in self._grid.nearest(latitude, longitude, count)
+                if distance <= radius
+            ]
+
+    def find_approaching(self, messenger_ids, latitude, longitude):
+        """Check whether drivers move towards the point, see Trail.approaching.
+
+        :param iterable messenger_ids: Driver identifiers
+        :param float latitude: Point latitude
+        :param float longitude: Point longitude
+        :return dict: messenger_id -> bool of drivers with known heading
+        """
+        result = {}
+        with self._lock:
+            for messenger_id in messenger_ids:
+                trail = self._trails.get(messenger_id)
+                approaching = trail.approaching(latitude, longitude) if trail else None
+                if approaching is not None:
+                    result[messenger_id] = approaching
+        return result
+
+    def find_driver_names(self, messenger_ids):
+        """Get driver names.
+
+        :param iterable messenger_ids: Driver identifiers
+        :return dict: messenger_id -> name of found drivers
+        """
+        drivers = self._drivers
+        return {
+            messenger_id: drivers[messenger_id].name
+            for messenger_id in messenger_ids
+            if messenger_id in drivers
+        }
+
+    def add_driver(self, messenger_id, phone, name, latitude, longitude, route):
+        """Add driver already inserted into the database.
+
+        :param int messenger_id: Driver identifier in telegram
+        :param str phone: Phone number
+        :param str name: Driver name
+        :param float latitude: Latitude
+        :param float longitude: Longitude
+        :param str route: Route key
+        """
+        driver = LiveDriver(
+            messenger_id,
+            phone,
+            name,
+            latitude,
+            longitude,
+            route,
+            "disabled",
+            datetime.datetime.now(),
+            1,
+        )
+        with self._lock:
+            self._drivers[messenger_id] = driver
+
+    def update_driver(self, messenger_id, **values):
+        """Update driver fields in memory and mark it dirty.
+
+        :param int messenger_id: Driver identifier in telegram
+        :param values: New latitude, longitude, route or state
+        :return LiveDriver: updated driver or None if not found
+        """
+        return self._update(messenger_id, values, history=False)
+
+    def update_location(self, messenger_id, latitude, longitude):
+        """Update driver location, add it to history if the driver is connected.
+
+        :param int messenger_id: Driver identifier in telegram
+        :param float latitude: Latitude
+        :param float longitude: Longitude
+        :return LiveDriver: updated driver or None if not found
+        """
+        return self._update(
+            messenger_id, {"latitude": latitude, "longitude": longitude}, history=True
+        )
+
+    def _update(self, messenger_id, values, history):
+        now = datetime.datetime.now()
+        with self._lock:
+            driver = self._drivers.get(messenger_id)
+            if driver is None:
+                return None
+            self._unindex(driver)
+            if "route" in values or "state" in values:
+                self._trails.pop(messenger_id, None)
+            for field, value in values.items():
+                setattr(driver, field, value)
+            if history and driver.state == "stale":
+                driver.state = "connected"
+            driver.last_update = now
+            driver.version += 1
+            self._index(driver)
+            if history:
+                self._track(driver, now.timestamp())
+            self._dirty.add(messenger_id)
+            self._counters["writes"] += 1
+            if history and driver.state == "connected":
+                self._add_history(
+                    {
+                        "messenger_id": messenger_id,
+                        "route": driver.route,
+                        "latitude": driver.latitude,
+                        "longitude": driver.longitude,
+                        "timestamp": now,
+                    }
+                )
+            return driver
+
+    def update_locations(self, locations):
+        """Apply a batch of locations in memory, see newer_locations.
+
+        :param list locations: dict(messenger_id, latitude, longitude, timestamp)
+                               in arrival order
+        :return tuple: (accepted, dropped, unknown, set of updated routes)
+        """
+        with self._lock:
+            accepted, dropped, unknown = newer_locations(locations, self._drivers)
+            routes = set()
+            for location in accepted:
+                driver = self._drivers[location["messenger_id"]]
+                driver.latitude = location["latitude"]
+                driver.longitude = location["longitude"]
+                driver.last_update = location["timestamp"]
+                driver.version += 1
+                if driver.state == "stale":
+                    driver.state = "connected"
+                self._index(driver)
+                self._track(driver, location["timestamp"].timestamp())
+                self._dirty.add(driver.messenger_id)
+                routes.add(driver.route)
+                if driver.state == "connected":
+                    self._add_history(dict(location, route=driver.route))
+            self._counters["writes"] += len(accepted)
+        return len(accepted), dropped, unknown, routes
+
+    def sweep(self, before, limit):
+        """Mark connected drivers not updated since the moment as stale.
+
+        Drivers are checked least recently updated first, the check stops at the
+        first fresh driver.
+
+        :param datetime.datetime before: Drivers updated before are stale
+        :param int limit: Max number of drivers to mark
+        :return tuple: (number of marked drivers, set of their routes)
+        """
+        routes = set()
+        count = 0
+        with self._lock:
+            while self._recent and count < limit:
+                driver = self._drivers[next(iter(self._recent))]
+                if driver.last_update >= before:
+                    break
+                self._unindex(driver)
+                self._trails.pop(driver.messenger_id, None)
+                driver.state = "stale"
+                driver.version += 1
+                self._dirty.add(driver.messenger_id)
+                routes.add(driver.route)
+                count += 1
+        return count, routes
+
+    def flush(self):
+        """Write dirty drivers and buffered history, call in application context.
+
+        :return int: number of written drivers
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            history = list(self._history)
+            self._history.clear()
+            rows = [
+                dict(
+                    {field: getattr(self._drivers[key], field) for field in FLUSHED_FIELDS},
+                    messenger_id=key,
+                )
+                for key in dirty
+                if key in self._drivers
+            ]
+        if not rows and not history:
+            return 0
+        try:
+            try:
+                if rows:
+                    query.update_drivers(rows)
+                if history:
+                    query.add_location_histories(history)
+            except exc.IntegrityError:
+                db.session.rollback()
+                # A refused row must not block the others
+                rows = _write_each(query.update_drivers, rows)
+                history = _write_each(query.add_location_histories, history)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Keep changes for the next flush, newer values win
+            with self._lock:
+                self._dirty.update(dirty)
+                newer = list(self._history)
+                self._history.clear()
+                for location in history + newer:
+                    self._add_history(location)
+            raise
+        with self._lock:
+            self._counters["flushes"] += 1
+            self._counters["flushed_drivers"] += len(rows)
+            self._counters["flushed_history"] += len(history)
+        return len(rows)
+
+    def start(self, app, interval):
+        """Enable the store and run flush job in background thread.
+
+        :param flask.Flask app: Application to run the job in its context
+        :param float interval: Seconds between flushes
+        """
+        self.enabled = True
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    with app.app_context():
+                        self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Fleet store flush error")
+
+        threading.Thread(target=run, name="fleet-store", daemon=True).start()
+
+    def stop(self):
+        """Stop background flush job."""
+        self._stop.set()
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: writes, flushes, flushed drivers and history locations,
+                      dropped history locations, drivers, connected drivers,
+                      dirty drivers, trails
+        """
+        with self._lock:
+            return dict(
+                self._counters,
+                drivers=len(self._drivers),
+                connected=sum(columns.size for columns in self._columns.values()),
+                dirty=len(self._dirty),
+                trails=len(self._trails),
+            )
+
+    def _add_history(self, location):
+        if len(self._history) == self._history.maxlen:
+            self._counters["dropped_history"] += 1
+        self._history.append(location)
+
+    def _track(self, driver, timestamp):
+        if driver.state != "connected":
+            return
+        trail = self._trails.get(driver.messenger_id)
+        if trail is None:
+            trail = self._trails[driver.messenger_id] = Trail(self.trail_size)
+        trail.append(timestamp, driver.latitude, driver.longitude)
+
+    def _index(self, driver):
+        if driver.state == "connected":
+            columns = self._columns.get(driver.route)
+            if columns is None:
+                columns = self._columns[driver.route] = RouteColumns()
+            columns.put(driver.messenger_id, driver.latitude, driver.longitude)
+            self._grid.insert(driver.messenger_id, driver.latitude, driver.longitude)
+            self._recent[driver.messenger_id] = None
+            self._recent.move_to_end(driver.messenger_id)
+
+    def _unindex(self, driver):
+        self._recent.pop(driver.messenger_id, None)
+        self._grid.remove(driver.messenger_id)
+        if driver.route in self._columns:
+            self._columns[driver.route].remove(driver.messenger_id)
+
+
+fleet_store = _FleetStore()
+
+
+def newer_locations(locations, drivers):
+    """Select locations of a batch to apply.
+
+    Locations of unknown drivers are skipped. A location not newer than the
+    driver last update or the previous accepted location of the driver in the
+    batch is out of order and dropped.
+
+    :param list locations: dict(messenger_id, latitude, longitude, timestamp)
+                           in arrival order
+    :param dict drivers: messenger_id -> driver
+    :return tuple: (accepted locations in arrival order, number of dropped,
+                    number of unknown)
+    """
+    accepted = []
+    latest = {}
+    dropped = unknown = 0
+    for location in locations:
+        messenger_id = location["messenger_id"]
+        driver = drivers.get(messenger_id)
+        if driver is None:
+            unknown += 1
+            continue
+        previous = latest.get(messenger_id, driver.last_update)
+        if previous is not None and location["timestamp"] <= previous:
+            dropped += 1
+            continue
+        latest[messenger_id] = location["timestamp"]
+        accepted.append(location)
+    return accepted, dropped, unknown
+
+
+def find_driver(messenger_id):
+    """Get driver from the fleet store if enabled, else from the database."""
+    if fleet_store.enabled:
+        return fleet_store.find_driver(messenger_id)
+    return query.find_driver(messenger_id)
+
+
+def find_route_columns(route):
+    """Get connected drivers on the route as arrays, see _FleetStore.find_route_columns."""
+    if fleet_store.enabled:
+        return fleet_store.find_route_columns(route)
+    rows = query.find_driver_locations_on_routes(routes=[route])
+    if not rows:
+        return _empty_columns()
+    ids, latitudes, longitudes = zip(*rows)
+    return (
+        np.array(ids, dtype=np.int64),
+        np.array(latitudes, dtype=np.float64),
+        np.array(longitudes, dtype=np.float64),
+    )
+
+
+def find_nearby_drivers(latitude, longitude, count, radius):
+    """Get connected drivers of all routes nearest to the location.
+
+    The fleet store answers from its location index, otherwise all connected
+    drivers are read from the database.
+
+    :param float latitude: Latitude
+    :param float longitude: Longitude
+    :param int count: Max number of drivers
+    :param float radius: Max distance in km
+    :return list: of tuple(distance, driver) nearest first
+    """
+    if fleet_store.enabled:
+        return fleet_store.find_nearby_drivers(latitude, longitude, count, radius)
+    drivers = query.find_connected_drivers()
+    distances = haversine_one_to_many(
+        latitude,
+        longitude,
+        [driver.latitude for driver in drivers],
+        [driver.longitude for driver in drivers],
+    )
+    order = np.argsort(distances, kind="stable")[:count]
+    return [(float(distances[i]), drivers[i]) for i in order if distances[i] <= radius]
+
+
+def find_approaching(messenger_ids, latitude, longitude):
+    """Check whether drivers move towards the point, see _FleetStore.find_approaching.
+
+    Without the fleet store no heading is known.
+    """
+    if fleet_store.enabled:
+        return fleet_store.find_approaching(messenger_ids, latitude, longitude)
+    return {}
+
+
+def find_driver_names(messenger_ids):
+    """Get driver names from the fleet store if enabled, else from the database.
+
+    :param iterable messenger_ids: Driver identifiers
+    :return dict: messenger_id -> name of found drivers
+    """
+    messenger_ids = [int(messenger_id) for messenger_id in messenger_ids]
+    if fleet_store.enabled:
+        return fleet_store.find_driver_names(messenger_ids)
+    if not messenger_ids:
+        return {}
+    return dict(query.find_driver_names(messenger_ids))
+
+
+def _write_each(write, rows):
+    """Write rows one at a time in savepoints, drop rows the database refuses.
+
+    :param callable write: Bulk write query taking a list of rows
+    :param list rows: Rows to write
+    :return list: written rows
+    """
+    written = []
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                write([row])
+        except exc.IntegrityError as error:
+            logger.error("Fleet store dropped row %s: %s", row, error)
+        else:
+            written.append(row)
+    return written
+
+
+def _empty_columns():
+    return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
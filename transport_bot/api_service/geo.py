@@ -0,0 +1,196 @@
+"""Spatial index over geographic points."""
+
+import heapq
+import math
+
+from transport_bot.api_service.distance import EARTH_RADIUS_KM, haversine_one_to_many
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class GridIndex:
+    """Uniform latitude/longitude grid of keyed points.
+
+    Points are bucketed into square cells of ``cell_km`` kilometers along the meridian.
+    Queries scan cells in square rings around the query cell and stop as soon as
+    the remaining rings cannot contain a closer point, so their cost depends on
+    the number of points near the query rather than on the size of the index.
+
+    Longitude wrap-around at the antimeridian is not handled, which is fine for
+    city-scale data.
+    """
+
+    def __init__(self, cell_km=0.5):
+        """Create empty index.
+
+        :param float cell_km: Cell size in km
+        """
+        self._cell = cell_km / KM_PER_DEGREE
+        self._cells = {}
+        self._points = {}
+        # Occupied cell bounds: (min_row, max_row, min_col, max_col).
+        # Only grows on insert, that keeps ring clipping conservative.
+        self._bounds = None
+
+    def __len__(self):
+        """Get number of points."""
+        return len(self._points)
+
+    def __contains__(self, key):
+        """Check point key."""
+        return key in self._points
+
+    def location(self, key):
+        """Get point coordinates.
+
+        :param key: Point key
+        :return tuple(float, float): latitude and longitude
+        """
+        latitude, longitude, _ = self._points[key]
+        return latitude, longitude
+
+    def insert(self, key, latitude, longitude):
+        """Insert point or move existing one.
+
+        :param key: Point key
+        :param float latitude: Point latitude
+        :param float longitude: Point longitude
+        """
+        cell = self._cell_of(latitude, longitude)
+        previous = self._points.get(key)
+        if previous is not None and previous[2] != cell:
+            self._discard(key, previous[2])
+        self._points[key] = (latitude, longitude, cell)
+        self._cells.setdefault(cell, set()).add(key)
+        row, col = cell
+        if self._bounds is None:
+            self._bounds = (row, row, col, col)
+        else:
+            min_row, max_row, min_col, max_col = self._bounds
+            self._bounds = (
+                min(min_row, row),
+                max(max_row, row),
+                min(min_col, col),
+                max(max_col, col),
+            )
+
+    def remove(self, key):
+        """Remove point if present.
+
+        :param key: Point key
+        """
+        previous = self._points.pop(key, None)
+        if previous is not None:
+            self._discard(key, previous[2])
+
+    def iter_nearest(self, latitude, longitude):
+        """Iterate points ordered by distance.
+
+        :param float latitude: Query latitude
+        :param float longitude: Query longitude
+        :return generator: of tuple(distance_km, key)
+        """
+        if not self._points:
+            return
+        row, col = self._cell_of(latitude, longitude)
+        min_row, max_row, min_col, max_col = self._bounds
+        # Rings that do not reach the occupied area are empty, skip them.
+        ring = max(min_row - row, row - max_row, min_col - col, col - max_col, 0)
+        heap = []
+        while True:
+            keys, latitudes, longitudes = [], [], []
+            for cell in self._ring_cells(row, col, ring):
+                for key in tuple(self._cells.get(cell, ())):
+                    item = self._points.get(key)
+                    if item is not None:
+                        keys.append(key)
+                        latitudes.append(item[0])
+                        longitudes.append(item[1])
+            if keys:
+                distances = haversine_one_to_many(latitude, longitude, latitudes, longitudes)
+                for distance, key in zip(distances.tolist(), keys):
+                    heapq.heappush(heap, (distance, key))
+            covered = (
+                row - ring <= min_row
+                and row + ring >= max_row
+                and col - ring <= min_col
+                and col + ring >= max_col
+            )
+            bound = math.inf if covered else self._ring_bound(latitude, longitude, row, col, ring)
+            while heap and heap[0][0] <= bound:
+                yield heapq.heappop(heap)
+            if covered:
+                return
+            ring += 1
+
+    def nearest(self, latitude, longitude, count=1):
+        """Get nearest points.
+
+        :param float latitude: Query latitude
+        :param float longitude: Query longitude
+        :param int count: Max number of points
+        :return list: of tuple(distance_km, key) ordered by distance
+        """
+        result = []
+        if count <= 0:
+            return result
+        for item in self.iter_nearest(latitude, longitude):
+            result.append(item)
+            if len(result) >= count:
+                break
+        return result
+
+    def within(self, latitude, longitude, radius):
+        """Get points inside radius.
+
+        :param float latitude: Query latitude
+        :param float longitude: Query longitude
+        :param float radius: Radius in km
+        :return list: of tuple(distance_km, key) ordered by distance
+        """
+        result = []
+        for distance, key in self.iter_nearest(latitude, longitude):
+            if distance > radius:
+                break
+            result.append((distance, key))
+        return result
+
+    def _cell_of(self, latitude, longitude):
+        return math.floor(latitude / self._cell), math.floor(longitude / self._cell)
+
+    def _discard(self, key, cell):
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def _ring_cells(self, row, col, ring):
+        min_row, max_row, min_col, max_col = self._bounds
+        if ring == 0:
+            yield row, col
+            return
+        for y in range(max(row - ring, min_row), min(row + ring, max_row) + 1):
+            if y in (row - ring, row + ring):
+                for x in range(max(col - ring, min_col), min(col + ring, max_col) + 1):
+                    yield y, x
+            else:
+                for x in (col - ring, col + ring):
+                    if min_col <= x <= max_col:
+                        yield y, x
+
+    def _ring_bound(self, latitude, longitude, row, col, ring):
+        """Lower bound of the distance to any point outside of scanned rings."""
+        south = (row - ring) * self._cell
+        north = (row + ring + 1) * self._cell
+        west = (col - ring) * self._cell
+        east = (col + ring + 1) * self._cell
+        cos_lat = math.cos(math.radians(latitude))
+        bounds = [
+            math.radians(north - latitude),
+            math.radians(latitude - south),
+        ]
+        for delta in (east - longitude, longitude - west):
+            delta = math.radians(min(delta, 90))
+            bounds.append(math.asin(min(1.0, cos_lat * math.sin(delta))))
+        return EARTH_RADIUS_KM * min(bounds)
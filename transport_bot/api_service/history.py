@@ -0,0 +1,254 @@
+"""Segment travel times learned from driver location history."""
+
+import datetime
+import logging
+import threading
+
+import numpy as np
+
+from transport_bot.api_service import query
+from transport_bot.api_service.route import AT_STOP_DISTANCE, route_data
+from transport_bot.api_service.schema import db
+
+logger = logging.getLogger(__name__)
+
+# Locations read from history at once
+BATCH_SIZE = 1000
+# Samples averaged before the segment mean becomes a moving average
+MEAN_WINDOW = 100
+
+
+class _Track:
+    """Driver movement along a route between aggregation runs."""
+
+    __slots__ = ("route", "offset", "timestamp", "stop", "stop_timestamp")
+
+    def __init__(self, route, offset, timestamp):
+        self.route = route
+        self.offset = offset
+        self.timestamp = timestamp
+        # Position of the last crossed stop and time of crossing
+        self.stop = None
+        self.stop_timestamp = None
+
+
+class _SegmentModel:
+    """Travel times between consecutive route stops by time of day.
+
+    The aggregation job reads driver locations added to history since its last
+    run and projects them onto the route line. The moment a driver crosses a stop
+    is interpolated between two consecutive locations, time between crossings of
+    consecutive stops is a sample of segment travel time. Samples go to the bucket
+    of the time of day the driver entered the segment, the bucket duration is the
+    mean of its first MEAN_WINDOW samples, then an exponential moving average
+    where a new sample has weight 1 / MEAN_WINDOW. A bucket with less than
+    ``min_samples`` samples is cold.
+    A driver that stays silent for ``max_gap`` seconds, leaves the route line or
+    moves backwards starts a new track. Tracks silent for ``max_gap`` seconds
+    before the newest location read are dropped after every run.
+    """
+
+    def __init__(self):
+        self.bucket_minutes = 60
+        self.min_samples = 3
+        self.max_gap = 300
+        self.retention = 7
+        self.off_route = 0.3
+        self._times = {}
+        self._tracks = {}
+        self._last_id = 0
+        self._counters = {"locations": 0, "samples": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def set_config(
+        self, bucket_minutes=60, min_samples=3, max_gap=300, retention=7, off_route=0.3
+    ):
+        """Set configuration and forget learned times.
+
+        :param int bucket_minutes: Time of day bucket size in minutes
+        :param int min_samples: Min number of samples to use bucket duration
+        :param float max_gap: Max seconds between consecutive locations of one track
+        :param float retention: Days to keep location history
+        :param float off_route: Max distance in km from driver to the route line
+        """
+        with self._lock:
+            self.bucket_minutes = bucket_minutes
+            self.min_samples = min_samples
+            self.max_gap = max_gap
+            self.retention = retention
+            self.off_route = off_route
+            self._times = {}
+            self._tracks = {}
+            self._last_id = 0
+            self._counters = {"locations": 0, "samples": 0}
+
+    def load(self):
+        """Load learned times from the database, call in application context.
+
+        Locations already in history are skipped: most of them are part of the
+        loaded times, and the tracks of the others are lost with the restart.
+        """
+        times = {
+            (row.route, row.segment, row.bucket): [row.duration, row.samples]
+            for row in query.find_segment_times()
+        }
+        last_id = query.find_last_location_history_id()
+        with self._lock:
+            self._times = times
+            self._last_id = last_id
+
+    def bucket(self, moment):
+        """Get time of day bucket.
+
+        :param datetime.datetime moment: Local time
+        :return int: bucket number
+        """
+        return (moment.hour * 60 + moment.minute) // self.bucket_minutes
+
+    def durations(self, route, moment=None):
+        """Get learned travel times of route segments.
+
+        :param str route: Route key
+        :param datetime.datetime moment: Local time, now by default
+        :return numpy.ndarray: seconds per segment between consecutive stops,
+                               nan for cold segments
+        """
+        bucket = self.bucket(moment or datetime.datetime.now())
+        count = max(len(route_data["routes"][route]["stops"]) - 1, 0)
+        result = np.full(count, np.nan)
+        with self._lock:
+            for segment in range(count):
+                learned = self._times.get((route, segment, bucket))
+                if learned is not None and learned[1] >= self.min_samples:
+                    result[segment] = learned[0]
+        return result
+
+    def aggregate(self):
+        """Learn from locations added to history since the last run.
+
+        Call in application context.
+
+        :return int: number of processed locations
+        """
+        processed = 0
+        updated = set()
+        newest = None
+        while True:
+            rows = query.find_location_history(self._last_id, BATCH_SIZE)
+            if not rows:
+                break
+            # Only the aggregation job uses tracks, passengers wait for the merge only
+            samples = []
+            for row in rows:
+                if row.route in route_data["routes"]:
+                    samples.extend(self._add_location(row))
+            newest = max(newest or 0, max(row.timestamp.timestamp() for row in rows))
+            with self._lock:
+                for key, duration in samples:
+                    self._learn(key, duration)
+                    updated.add(key)
+                self._last_id = rows[-1].id
+                self._counters["locations"] += len(rows)
+            processed += len(rows)
+
+        with self._lock:
+            if newest is not None:
+                # Drivers gone for good must not keep their tracks
+                self._tracks = {
+                    messenger_id: track
+                    for messenger_id, track in self._tracks.items()
+                    if track.timestamp >= newest - self.max_gap
+                }
+            times = {key: tuple(self._times[key]) for key in updated}
+        for (route, segment, bucket), (duration, samples) in times.items():
+            query.save_segment_time(route, segment, bucket, duration, samples)
+        query.delete_location_history(
+            datetime.datetime.now() - datetime.timedelta(days=self.retention)
+        )
+        db.session.commit()
+        return processed
+
+    def start(self, app, interval):
+        """Run aggregation job in background thread.
+
+        :param flask.Flask app: Application to run the job in its context
+        :param float interval: Seconds between job runs
+        """
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    with app.app_context():
+                        count = self.aggregate()
+                    logger.debug("Segment model learned from %s locations", count)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Segment model aggregation error")
+
+        threading.Thread(target=run, name="segment-model", daemon=True).start()
+
+    def stop(self):
+        """Stop background aggregation job."""
+        self._stop.set()
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: processed locations, learned samples, tracked drivers and
+                      warm segment buckets
+        """
+        with self._lock:
+            warm = sum(1 for _, samples in self._times.values() if samples >= self.min_samples)
+            return dict(self._counters, tracks=len(self._tracks), warm=warm)
+
+    def _add_location(self, row):
+        """Advance driver track, return (segment bucket key, duration) samples."""
+        (offset,), (off_route,) = route_data.route_lines[row.route].locate(
+            [row.latitude], [row.longitude]
+        )
+        timestamp = row.timestamp.timestamp()
+        track = self._tracks.get(row.messenger_id)
+        if off_route > self.off_route:
+            self._tracks.pop(row.messenger_id, None)
+            return []
+        if (
+            track is None
+            or track.route != row.route
+            or timestamp - track.timestamp > self.max_gap
+            or offset < track.offset - AT_STOP_DISTANCE
+        ):
+            track = self._tracks[row.messenger_id] = _Track(row.route, offset, timestamp)
+            # A track starting at a stop has just crossed it
+            stop_offsets = route_data.route_stop_offsets[row.route]
+            position = np.searchsorted(stop_offsets, offset, side="right") - 1
+            if position >= 0 and offset - stop_offsets[position] <= AT_STOP_DISTANCE:
+                track.stop = int(position)
+                track.stop_timestamp = timestamp
+            return []
+
+        samples = []
+        stop_offsets = route_data.route_stop_offsets[row.route]
+        first = np.searchsorted(stop_offsets, track.offset, side="right")
+        last = np.searchsorted(stop_offsets, offset, side="right")
+        for position in range(first, last):
+            share = (stop_offsets[position] - track.offset) / max(offset - track.offset, 1e-9)
+            crossed_at = track.timestamp + share * (timestamp - track.timestamp)
+            if track.stop == position - 1 and crossed_at > track.stop_timestamp:
+                moment = datetime.datetime.fromtimestamp(track.stop_timestamp)
+                key = (row.route, position - 1, self.bucket(moment))
+                samples.append((key, crossed_at - track.stop_timestamp))
+            track.stop = position
+            track.stop_timestamp = crossed_at
+        track.offset = max(offset, track.offset)
+        track.timestamp = timestamp
+        return samples
+
+    def _learn(self, key, duration):
+        learned = self._times.setdefault(key, [duration, 0])
+        learned[1] += 1
+        learned[0] += (duration - learned[0]) / min(learned[1], MEAN_WINDOW)
+        self._counters["samples"] += 1
+
+
+segment_model = _SegmentModel()
@@ -0,0 +1,111 @@
+"""Fan-out of arrival board changes to subscribers."""
+
+import threading
+
+
+class _Topic:
+    """Latest data of one key and subscribers waiting for its change."""
+
+    __slots__ = ("version", "data", "condition", "subscribers")
+
+    def __init__(self, data):
+        self.version = 0
+        self.data = data
+        self.condition = threading.Condition()
+        self.subscribers = 0
+
+
+class _Hub:
+    """Deliver the latest data of a key to its subscribers.
+
+    Only the latest version of the data is kept per key, so an idle subscriber
+    costs a wait on its key condition and nothing else: publishing wakes only the
+    subscribers of the changed key, and a slow subscriber skips intermediate
+    versions instead of queueing them. Keys without subscribers are not stored.
+    """
+
+    def __init__(self):
+        self.max_subscribers = 1000
+        self._topics = {}
+        self._subscribers = 0
+        self._lock = threading.Lock()
+        self._counters = {"published": 0, "rejected": 0}
+
+    def set_config(self, max_subscribers=1000):
+        """Set configuration.
+
+        :param int max_subscribers: Max number of subscribers of all keys
+        """
+        self.max_subscribers = max_subscribers
+
+    def subscribe(self, key, data):
+        """Add subscriber of the key.
+
+        :param key: Hashable key
+        :param data: Current data of the key, used if the key has no subscribers yet
+        :return _Topic: to wait on, None if there are too many subscribers
+        """
+        with self._lock:
+            if self._subscribers >= self.max_subscribers:
+                self._counters["rejected"] += 1
+                return None
+            topic = self._topics.get(key)
+            if topic is None:
+                topic = self._topics[key] = _Topic(data)
+            topic.subscribers += 1
+            self._subscribers += 1
+            return topic
+
+    def unsubscribe(self, key):
+        """Remove subscriber of the key.
+
+        :param key: Hashable key
+        """
+        with self._lock:
+            topic = self._topics[key]
+            topic.subscribers -= 1
+            self._subscribers -= 1
+            if not topic.subscribers:
+                del self._topics[key]
+
+    def publish(self, key, data):
+        """Set data of the key and wake its subscribers if the data has changed.
+
+        :param key: Hashable key
+        :param data: New data
+        """
+        topic = self._topics.get(key)
+        if topic is None:
+            return
+        with topic.condition:
+            if topic.data == data:
+                return
+            topic.data = data
+            topic.version += 1
+            topic.condition.notify_all()
+        with self._lock:
+            self._counters["published"] += 1
+
+    @staticmethod
+    def wait(topic, version, timeout):
+        """Wait for data newer than version.
+
+        :param _Topic topic: Subscribed topic
+        :param int version: Last received version, None to get the current data at once
+        :param float timeout: Max seconds to wait
+        :return tuple: (version, data), the same version on timeout
+        """
+        with topic.condition:
+            topic.condition.wait_for(lambda: topic.version != version, timeout=timeout)
+            return topic.version, topic.data
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: subscribers, subscribed keys, published changes and rejected subscribers
+        """
+        with self._lock:
+            return dict(self._counters, subscribers=self._subscribers, keys=len(self._topics))
+
+
+arrival_hub = _Hub()
@@ -1,14 +1,34 @@
 """Passenger http api."""
 
-import haversine
-from webargs import fields
+import functools
+import json
 
-from transport_bot.api_service import query
-from transport_bot.api_service.common import resp, use_body
+import numpy as np
+from flask import Response
+from webargs import fields, validate
+
+from transport_bot.api_service import fleet
+from transport_bot.api_service.board import arrival_board
+from transport_bot.api_service.common import resp, use_body, use_query
+from transport_bot.api_service.distance import haversine_one_to_many
+from transport_bot.api_service.eta import MAX_RADIUS, ROUTE, estimator
+from transport_bot.api_service.hub import arrival_hub
+from transport_bot.api_service.quota import PRIORITY_REVERSE
 from transport_bot.api_service.route import route_client, route_data
 from transport_bot.api_service.schema import app
+from transport_bot.api_service.singleflight import SingleFlight
+
+NEARBY_STOPS_COUNT = 5
+NEARBY_STOPS_MAX_COUNT = 50
+NEARBY_VEHICLES_COUNT = 5
+NEARBY_VEHICLES_MAX_COUNT = 50
+STOP_ARRIVALS_COUNT = 3
+STOP_ARRIVALS_MAX_COUNT = 10
+# Seconds between keepalive comments of an idle arrivals stream
+STREAM_KEEPALIVE = 15
 
-MAX_RADIUS = 4
+# Identical (stop, route) requests share one nearest driver search
+nearest_driver_flight = SingleFlight()
 
 
 @app.route("/passenger/get_routes", methods=["POST"])
@@ -26,9 +46,77 @@ def get_route(body):
     stop = tokens[1].strip()
     if stop not in route_data["stops"]:
         return resp(data={"error": "Unknown stop"})
-    stop_info = _get_stop_info(stop)
-    routes = sorted(list(stop_info["routes"].values()), key=lambda d: d["key"])
-    return resp(data={"routes": routes, "stop": stop_info["stop"]})
+    return resp(data={"routes": route_data.stop_route_list[stop], "stop": _get_stop_info(stop)})
+
+
+@app.route("/passenger/get_nearby_stops", methods=["POST"])
+@use_body(
+    {
+        "latitude": fields.Float(required=True, validate=[validate.Range(min=-90, max=90)]),
+        "longitude": fields.Float(required=True, validate=[validate.Range(min=-180, max=180)]),
+        "count": fields.Integer(
+            load_default=NEARBY_STOPS_COUNT,
+            validate=[validate.Range(min=1, max=NEARBY_STOPS_MAX_COUNT)],
+        ),
+    }
+)
+def get_nearby_stops(body):
+    """Get stops nearest to the passenger location.
+
+    :param dict body: Contains latitude, longitude and optional count
+    :return Flask.Response: status=200 and json with format dict(stops) where
+                            every stop has stop details, distance and relevant routes
+    """
+    stops = []
+    for distance, stop in route_data.nearest_stops(
+        body["latitude"], body["longitude"], body["count"]
+    ):
+        stop_info = _get_stop_info(stop)
+        stop_info["distance"] = round(distance, 2)
+        stop_info["routes"] = route_data.stop_route_list[stop]
+        stops.append(stop_info)
+    return resp(data={"stops": stops})
+
+
+@app.route("/passenger/get_nearby_vehicles", methods=["POST"])
+@use_body(
+    {
+        "latitude": fields.Float(required=True, validate=[validate.Range(min=-90, max=90)]),
+        "longitude": fields.Float(required=True, validate=[validate.Range(min=-180, max=180)]),
+        "count": fields.Integer(
+            load_default=NEARBY_VEHICLES_COUNT,
+            validate=[validate.Range(min=1, max=NEARBY_VEHICLES_MAX_COUNT)],
+        ),
+        "radius": fields.Float(
+            load_default=MAX_RADIUS, validate=[validate.Range(min=0, max=MAX_RADIUS)]
+        ),
+    }
+)
+def get_nearby_vehicles(body):
+    """Get connected drivers of all routes nearest to the passenger location.
+
+    :param dict body: Contains latitude, longitude, optional count and radius in km
+    :return Flask.Response: status=200 and json with format dict(vehicles) where every
+                            vehicle has name, route dict(key, name), distance in a
+                            straight line, latitude and longitude
+    """
+    vehicles = []
+    for distance, driver in fleet.find_nearby_drivers(
+        body["latitude"], body["longitude"], body["count"], body["radius"]
+    ):
+        route = route_data["routes"].get(driver.route)
+        if route is None:
+            continue
+        vehicles.append(
+            {
+                "name": driver.name,
+                "route": {"key": driver.route, "name": route["name"]},
+                "distance": round(distance, 2),
+                "latitude": driver.latitude,
+                "longitude": driver.longitude,
+            }
+        )
+    return resp(data={"vehicles": vehicles})
 
 
 @app.route("/passenger/get_nearest_driver", methods=["POST"])
@@ -38,51 +126,256 @@ def get_nearest_driver(body):
 
     :param dict body: With keys "stop" and "route"
     :return Flask.Response: status=200 and json with format dict(name, distance, duration)
+                            and approximate=True for a local estimate
+    """
+    error = _check_stop_route(body["stop"], body["route"])
+    if error:
+        return resp(data={"error": error})
+    if arrival_board.enabled:
+        arrivals = arrival_board.get(body["stop"], body["route"])
+        return resp(data=dict(arrivals[0]) if arrivals else None)
+    data = nearest_driver_flight.do(
+        (body["stop"], body["route"]),
+        functools.partial(_find_nearest_driver, body["stop"], body["route"]),
+    )
+    return resp(data=data)
+
+
+@app.route("/passenger/get_arrivals", methods=["POST"])
+@use_body({"stop": fields.String(required=True), "route": fields.String(required=True)})
+def get_arrivals(body):
+    """Get next drivers arriving at the stop from the arrival board.
+
+    :param dict body: With keys "stop" and "route"
+    :return Flask.Response: status=200 and json with format dict(error) or dict(arrivals)
+                            with list of dict(name, distance, duration) nearest first
+    """
+    error = _check_stop_route(body["stop"], body["route"])
+    if error:
+        return resp(data={"error": error})
+    if not arrival_board.enabled:
+        return resp(data={"error": "Arrival board is disabled"})
+    return resp(data={"arrivals": arrival_board.get(body["stop"], body["route"])})
+
+
+@app.route("/passenger/subscribe_arrivals", methods=["GET"])
+@use_query({"stop": fields.String(required=True), "route": fields.String(required=True)})
+def subscribe_arrivals(args):
+    """Stream arrival board of the stop as Server-Sent Events.
+
+    The current board is sent at once, then every time it changes. Every event
+    is "arrivals" with data dict(arrivals) as returned by get_arrivals.
+
+    :param dict args: Query with keys "stop" and "route"
+    :return Flask.Response: status=200 and text/event-stream, status=200 and json
+                            with format dict(error), or status=503 when there
+                            are too many subscribers
+    """
+    error = _check_stop_route(args["stop"], args["route"])
+    if error:
+        return resp(data={"error": error})
+    if not arrival_board.enabled:
+        return resp(data={"error": "Arrival board is disabled"})
+    key = (args["stop"], args["route"])
+    topic = arrival_hub.subscribe(key, arrival_board.get(*key))
+    if topic is None:
+        return resp(503, {"detail": "Too many subscribers"})
+
+    def stream():
+        version = None
+        try:
+            while True:
+                current, arrivals = arrival_hub.wait(topic, version, STREAM_KEEPALIVE)
+                if current == version:
+                    yield ": keepalive\n\n"
+                    continue
+                version = current
+                data = json.dumps({"arrivals": arrivals})
+                yield f"id: {version}\nevent: arrivals\ndata: {data}\n\n"
+        finally:
+            arrival_hub.unsubscribe(key)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/passenger/get_stop_arrivals", methods=["POST"])
+@use_body(
+    {
+        "stop": fields.String(required=True),
+        "count": fields.Integer(
+            load_default=STOP_ARRIVALS_COUNT,
+            validate=[validate.Range(min=1, max=STOP_ARRIVALS_MAX_COUNT)],
+        ),
+    }
+)
+def get_stop_arrivals(body):
+    """Get next drivers arriving at the stop on every route passing through it.
+
+    Drivers of all routes are estimated at once: one driver lookup and,
+    in ORS mode, one ORS matrix request per direction.
+
+    :param dict body: With key "stop" and optional "count" of drivers per route
+    :return Flask.Response: status=200 and json with format dict(error) or
+                            dict(stop, routes) with stop detail and list of
+                            dict(key, name, arrivals) where arrivals is a list
+                            of dict(name, distance, duration) nearest first
     """
-    if body["stop"] not in route_data["stops"]:
+    stop = body["stop"]
+    if stop not in route_data["stops"]:
         return resp(data={"error": "Unknown stop"})
-    if body["route"] not in route_data["routes"]:
-        return resp(data={"error": "Unknown route"})
-    stop_info = _get_stop_info(body["stop"])
-    if body["route"] not in stop_info["routes"]:
-        return resp(data={"error": "No stop for route"})
-    drivers = query.find_drivers_on_routes(routes=[body["route"]])
-    if not drivers:
-        return resp()
-    stop_loc = stop_info["stop"]["location"]
-    results = []
-    for driver in drivers:
-        distance = haversine.haversine(
-            (driver.latitude, driver.longitude), (stop_loc["lat"], stop_loc["lon"])
+    # Boards hold arrival_board.size drivers, larger counts are computed on request
+    if arrival_board.enabled and body["count"] <= arrival_board.size:
+        arrivals = {
+            route: arrival_board.get(stop, route) for route in route_data.stop_routes[stop]
+        }
+    else:
+        arrivals = nearest_driver_flight.do(
+            (stop, None, body["count"]),
+            functools.partial(_find_stop_arrivals, stop, body["count"]),
         )
-        if distance > MAX_RADIUS:
-            continue
-        summary = route_client.get_ors_route_info(
-            driver.latitude, driver.longitude, stop_loc["lat"], stop_loc["lon"]
-        )
-        if not summary or summary["distance"] > MAX_RADIUS:
-            continue
+    routes = [
+        dict(route, arrivals=list(arrivals[route["key"]][: body["count"]]))
+        for route in route_data.stop_route_list[stop]
+    ]
+    return resp(data={"stop": _get_stop_info(stop), "routes": routes})
 
-        # Compute reverse route and skip if this distance less
-        summary_revert = route_client.get_ors_route_info(
-            stop_loc["lat"], stop_loc["lon"], driver.latitude, driver.longitude
-        )
+
+def _check_stop_route(stop, route):
+    if stop not in route_data["stops"]:
+        return "Unknown stop"
+    if route not in route_data["routes"]:
+        return "Unknown route"
+    if stop not in route_data.route_stop_positions[route]:
+        return "No stop for route"
+    return None
+
+
+def _find_nearest_driver(stop, route):
+    arrivals = _find_arrivals(stop, [route], 1, by_distance=True)[route]
+    return arrivals[0] if arrivals else {}
+
+
+def _find_stop_arrivals(stop, count):
+    return _find_arrivals(stop, sorted(route_data.stop_routes[stop]), count)
+
+
+def _find_arrivals(stop, routes, count, by_distance=False):
+    """Estimate arrival at the stop of drivers of one or many routes.
+
+    Drivers are read as arrays per route, only the selected drivers are
+    looked up by name. In ORS mode routes of all drivers are requested at once.
+
+    :param str stop: Stop key
+    :param list routes: Route keys
+    :param int count: Max number of drivers per route
+    :param bool by_distance: Order by distance, otherwise by duration and distance
+    :return dict: route -> list of dict(name, distance, duration) first arriving first
+    """
+    columns = {route: fleet.find_route_columns(route) for route in routes}
+    if estimator.mode == ROUTE:
+        selected = {
+            route: [
+                (int(ids[index]), summary)
+                for index, summary in estimator.nearest(
+                    route, stop, latitudes, longitudes, count, by_distance
+                )
+            ]
+            for route, (ids, latitudes, longitudes) in columns.items()
+        }
+    else:
+        selected = _find_arrivals_by_ors(stop, columns, count, by_distance)
+    names = fleet.find_driver_names(
+        {messenger_id for arrivals in selected.values() for messenger_id, _ in arrivals}
+    )
+    return {
+        route: [
+            dict(summary, name=names[messenger_id])
+            for messenger_id, summary in arrivals
+            if messenger_id in names
+        ]
+        for route, arrivals in selected.items()
+    }
+
+
+def _find_arrivals_by_ors(stop, columns, count, by_distance):
+    if not columns:
+        return {}
+    ids = np.concatenate([ids for ids, _, _ in columns.values()])
+    latitudes = np.concatenate([latitudes for _, latitudes, _ in columns.values()])
+    longitudes = np.concatenate([longitudes for _, _, longitudes in columns.values()])
+    routes = np.repeat(list(columns), [len(ids) for ids, _, _ in columns.values()])
+    selected = {route: [] for route in columns}
+    if not len(ids):
+        return selected
+
+    stop_loc = route_data["stops"][stop]["location"]
+    distances = haversine_one_to_many(stop_loc["lat"], stop_loc["lon"], latitudes, longitudes)
+    # Nearest drivers first: they are the most valuable when ORS quota runs out
+    order = np.argsort(distances, kind="stable")
+    candidates = order[distances[order] <= MAX_RADIUS].tolist()
+    # Drivers heading away from the stop have passed it
+    approaching = fleet.find_approaching(
+        ids[candidates].tolist(), stop_loc["lat"], stop_loc["lon"]
+    )
+    candidates = [index for index in candidates if approaching.get(int(ids[index]), True)]
+    stop_point = (stop_loc["lat"], stop_loc["lon"])
+    points = list(zip(latitudes[candidates].tolist(), longitudes[candidates].tolist()))
+    results = []
+    if route_client.available():
+        known = [int(ids[index]) in approaching for index in candidates]
+        results = _nearest_by_ors(candidates, points, stop_point, known)
+    if not results and not route_client.available():
+        # ORS is down: answer with approximate local estimate
+        forward = route_client.estimate_matrix_info(points, [stop_point])
+        results = [
+            (summary["distance"], summary, index)
+            for index, (summary,) in zip(candidates, forward)
+            if summary["distance"] <= MAX_RADIUS
+        ]
+
+    key = (lambda r: r[0]) if by_distance else (lambda r: (r[1]["duration"], r[0]))
+    for _, summary, index in sorted(results, key=key):
+        arrivals = selected[routes[index]]
+        if len(arrivals) < count:
+            arrivals.append((int(ids[index]), summary))
+    return selected
+
+
+def _nearest_by_ors(candidates, points, stop_point, known):
+    """Request routes from candidates to the stop.
+
+    The direction of a driver with unknown heading is guessed by the reverse
+    route: the driver has passed the stop if the route back is shorter.
+    """
+    deadline = route_client.new_deadline()
+    forward = route_client.get_ors_matrix_info(points, [stop_point], deadline)
+    reachable = [
+        (index, point, summary, heading)
+        for index, point, (summary,), heading in zip(candidates, points, forward, known)
+        if summary and summary["distance"] <= MAX_RADIUS
+    ]
+    results = [
+        (summary["distance"], summary, index)
+        for index, _, summary, heading in reachable
+        if heading
+    ]
+    unknown = [item for item in reachable if not item[3]]
+    if not unknown:
+        return results
+
+    (reverse,) = route_client.get_ors_matrix_info(
+        [stop_point], [p for _, p, _, _ in unknown], deadline, PRIORITY_REVERSE
+    )
+    for (index, _, summary, _), summary_revert in zip(unknown, reverse):
         if summary_revert and summary["distance"] > summary_revert["distance"]:
             continue
-        results.append((summary["distance"], summary, driver.name))
-    if results:
-        _, nearest_summary, driver_name = list(sorted(results))[0]
-        nearest_summary["name"] = driver_name
-        return resp(data=nearest_summary)
-    return resp()
+        results.append((summary["distance"], summary, index))
+    return results
 
 
 def _get_stop_info(stop):
-    stop_data = route_data["stops"][stop]
-    stop_data = dict(**stop_data, **{"key": stop})
-    routes = {}
-    for route, data in route_data["routes"].items():
-        if stop in data["stops"]:
-            routes[route] = {"name": data["name"], "key": route}
-    result = {"stop": stop_data, "routes": routes}
-    return result
+    return dict(**route_data["stops"][stop], **{"key": stop})
@@ -0,0 +1,116 @@
+"""Route polylines and linear referencing."""
+
+import math
+
+import numpy as np
+
+from transport_bot.api_service.geo import KM_PER_DEGREE
+
+
+def encode(points):
+    """Encode (latitude, longitude) points to Google encoded polyline, precision 5."""
+    result = []
+    previous = (0, 0)
+    for point in points:
+        current = (round(point[0] * 1e5), round(point[1] * 1e5))
+        for value in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        previous = current
+    return "".join(result)
+
+
+def decode(polyline):
+    """Decode Google encoded polyline, precision 5, as returned by ORS.
+
+    :param str polyline: Encoded polyline
+    :return list: of tuple(latitude, longitude)
+    """
+    points = []
+    values = []
+    value, shift = 0, 0
+    for char in polyline:
+        byte = ord(char) - 63
+        value |= (byte & 0x1F) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    latitude, longitude = 0, 0
+    for i in range(0, len(values) - 1, 2):
+        latitude += values[i]
+        longitude += values[i + 1]
+        points.append((latitude / 1e5, longitude / 1e5))
+    return points
+
+
+class RouteLine:
+    """Polyline of a route with along-route offsets.
+
+    Points are projected to a local plane (equirectangular projection around the
+    line center), which is accurate enough at city scale. An offset is the length
+    in km of the line from its first point to the position.
+    """
+
+    def __init__(self, points, approximate=False):
+        """Create line.
+
+        :param list points: tuple(latitude, longitude) of line vertices, at least one
+        :param bool approximate: True if the line does not follow the roads,
+                                 e.g. straight lines between stops
+        :raises ValueError: on empty points
+        """
+        if not points:
+            raise ValueError("Empty route line")
+        if len(points) == 1:
+            points = [points[0], points[0]]
+        self.approximate = approximate
+        self.points = tuple((float(lat), float(lon)) for lat, lon in points)
+        self._lon_scale = math.cos(math.radians(sum(lat for lat, _ in self.points) / len(points)))
+        xy = self._project(
+            np.array([lat for lat, _ in self.points]), np.array([lon for _, lon in self.points])
+        )
+        self._start = xy[:-1]
+        self._delta = xy[1:] - xy[:-1]
+        lengths = np.hypot(self._delta[:, 0], self._delta[:, 1])
+        self._length_squared = np.maximum(lengths**2, 1e-18)
+        self._offsets = np.concatenate(([0.0], np.cumsum(lengths)))
+        self.length = float(self._offsets[-1])
+
+    def locate(self, latitudes, longitudes, start=0.0):
+        """Project points onto the line.
+
+        Every point is mapped to the nearest position of the line at or after
+        the ``start`` offset.
+
+        :param latitudes: Point latitudes, sequence or array
+        :param longitudes: Point longitudes, sequence or array
+        :param float start: Min offset in km
+        :return tuple: (offsets, distances) arrays in km: along-route offset of the
+                       nearest line position and distance from the point to it
+        """
+        xy = self._project(np.asarray(latitudes, np.float64), np.asarray(longitudes, np.float64))
+        # points x segments
+        relative = xy[:, None, :] - self._start[None, :, :]
+        ratio = (relative * self._delta[None, :, :]).sum(axis=2) / self._length_squared
+        lengths = self._offsets[1:] - self._offsets[:-1]
+        offsets = self._offsets[:-1] + np.clip(ratio, 0, 1) * lengths
+        offsets = np.maximum(offsets, start)
+        ratio = np.where(
+            lengths > 0, (offsets - self._offsets[:-1]) / np.maximum(lengths, 1e-18), 0
+        )
+        nearest = self._start[None, :, :] + ratio[:, :, None] * self._delta[None, :, :]
+        distances = np.hypot(*(xy[:, None, :] - nearest).transpose(2, 0, 1))
+        # Segments ending before start are out of reach
+        distances[:, self._offsets[1:] < start] = np.inf
+        best = distances.argmin(axis=1)
+        rows = np.arange(len(xy))
+        return offsets[rows, best], distances[rows, best]
+
+    def _project(self, latitudes, longitudes):
+        return np.stack(
+            (longitudes * self._lon_scale * KM_PER_DEGREE, latitudes * KM_PER_DEGREE), axis=-1
+        ).reshape(-1, 2)
@@ -1,18 +1,56 @@
 """DB queries."""
 
-from sqlalchemy import select, update
+from sqlalchemy import bindparam, case, delete, func, insert, select, update
 
-from transport_bot.api_service.schema import DriverTable, db
+from transport_bot.api_service.schema import (
+    DriverTable,
+    LocationHistoryTable,
+    SegmentTimeTable,
+    db,
+)
 
+# A location makes a stale driver connected again
+_STATE_ON_LOCATION = case((DriverTable.state == "stale", "connected"), else_=DriverTable.state)
 
-def find_driver(messenger_id, for_update):
+# Statements of every location update, built once
+_UPDATE_LOCATION = (
+    update(DriverTable.__table__)
+    .where(DriverTable.messenger_id == bindparam("b_messenger_id"))
+    .values(
+        latitude=bindparam("b_latitude"),
+        longitude=bindparam("b_longitude"),
+        state=_STATE_ON_LOCATION,
+        version=DriverTable.version + 1,
+    )
+)
+# Driver columns returned by updates
+_UPDATED = (DriverTable.route, DriverTable.state, DriverTable.version)
+_UPDATE_LOCATION_RETURNING = _UPDATE_LOCATION.returning(*_UPDATED)
+_INSERT_HISTORY = insert(LocationHistoryTable.__table__)
+
+
+def find_driver(messenger_id):
     """Select driver by messenger_id."""
     stmt = select(DriverTable).where(DriverTable.messenger_id == messenger_id)
-    if for_update:
-        stmt = stmt.with_for_update()
     return db.session.scalars(stmt).one_or_none()
 
 
+def find_drivers():
+    """Select all drivers."""
+    return db.session.scalars(select(DriverTable)).all()
+
+
+def find_drivers_by_ids(messenger_ids):
+    """Select drivers by messenger_ids."""
+    stmt = select(DriverTable).where(DriverTable.messenger_id.in_(messenger_ids))
+    return db.session.scalars(stmt).all()
+
+
+def update_drivers(rows):
+    """Update drivers by messenger_id in bulk, rows are dicts of column values."""
+    db.session.execute(update(DriverTable), rows)
+
+
 def add_driver(messenger_id, phone, name, latitude, longitude, route):
     """Add new driver."""
     driver = DriverTable(
@@ -27,33 +65,173 @@ def add_driver(messenger_id, phone, name, latitude, longitude, route):
     db.session.add(driver)
 
 
+def update_driver(messenger_id, version=None, **values):
+    """Update driver fields and increment its version in one statement.
+
+    :param int messenger_id: Driver identifier in telegram
+    :param int version: Update only if the driver still has this version
+    :param values: Column values
+    :return Row: (route, state, version) of the updated driver,
+                 None if not found or the version differs
+    """
+    stmt = update(DriverTable).where(DriverTable.messenger_id == messenger_id)
+    if version is not None:
+        stmt = stmt.where(DriverTable.version == version)
+    stmt = stmt.values(version=DriverTable.version + 1, **values).execution_options(
+        synchronize_session=False
+    )
+    if db.engine.dialect.update_returning:
+        return db.session.execute(stmt.returning(*_UPDATED)).one_or_none()
+    return _update_selecting(stmt, messenger_id)
+
+
 def update_driver_location(messenger_id, latitude, longitude):
-    """Update driver location."""
+    """Update driver location, a stale driver becomes connected.
+
+    :return Row: (route, state, version) of the updated driver, None if not found
+    """
+    params = {"b_messenger_id": messenger_id, "b_latitude": latitude, "b_longitude": longitude}
+    if db.engine.dialect.update_returning:
+        return db.session.execute(_UPDATE_LOCATION_RETURNING, params).one_or_none()
+    return _update_selecting(_UPDATE_LOCATION, messenger_id, params)
+
+
+def _update_selecting(stmt, messenger_id, params=None):
+    """Execute update of one driver, then select its (route, state, version).
+
+    UPDATE ... RETURNING needs SQLite 3.35, with an older SQLite the updated
+    row is selected in the same transaction.
+    """
+    if not db.session.execute(stmt, params).rowcount:
+        return None
+    return db.session.execute(
+        select(*_UPDATED).where(DriverTable.messenger_id == messenger_id)
+    ).one()
+
+
+def update_driver_locations(rows):
+    """Update driver locations in bulk, a stale driver becomes connected.
+
+    Rows are dicts(messenger_id, latitude, longitude, last_update), a row is
+    skipped if the driver has a newer location.
+    """
+    table = DriverTable.__table__
     stmt = (
-        update(DriverTable)
-        .where(DriverTable.messenger_id == messenger_id)
-        .values(latitude=latitude, longitude=longitude)
+        update(table)
+        .where(table.c.messenger_id == bindparam("b_messenger_id"))
+        .where(table.c.last_update < bindparam("b_last_update"))
+        .values(
+            latitude=bindparam("b_latitude"),
+            longitude=bindparam("b_longitude"),
+            last_update=bindparam("b_last_update"),
+            state=_STATE_ON_LOCATION,
+            version=table.c.version + 1,
+        )
     )
-    db.session.execute(stmt)
+    db.session.execute(stmt, [{f"b_{key}": value for key, value in row.items()} for row in rows])
 
 
-def update_driver_route(messenger_id, route):
-    """Update driver route."""
-    stmt = update(DriverTable).where(DriverTable.messenger_id == messenger_id).values(route=route)
-    db.session.execute(stmt)
+def find_connected_drivers():
+    """Select all connected drivers."""
+    return db.session.scalars(select(DriverTable).where(DriverTable.state == "connected")).all()
 
 
-def find_drivers_on_routes(routes):
-    """Select all connected drivers on routes."""
+def find_driver_locations_on_routes(routes):
+    """Select (messenger_id, latitude, longitude) of connected drivers on routes."""
     stmt = (
-        select(DriverTable)
+        select(DriverTable.messenger_id, DriverTable.latitude, DriverTable.longitude)
         .where(DriverTable.state == "connected")
         .where(DriverTable.route.in_(routes))
     )
+    return db.session.execute(stmt).all()
+
+
+def find_driver_names(messenger_ids):
+    """Select (messenger_id, name) of drivers by messenger_ids."""
+    stmt = select(DriverTable.messenger_id, DriverTable.name).where(
+        DriverTable.messenger_id.in_(messenger_ids)
+    )
+    return db.session.execute(stmt).all()
+
+
+def find_stale_drivers(before, limit):
+    """Select (messenger_id, route) of connected drivers not updated since the moment.
+
+    Least recently updated first.
+    """
+    stmt = (
+        select(DriverTable.messenger_id, DriverTable.route)
+        .where(DriverTable.state == "connected")
+        .where(DriverTable.last_update < before)
+        .order_by(DriverTable.last_update)
+        .limit(limit)
+    )
+    return db.session.execute(stmt).all()
+
+
+def mark_drivers_stale(messenger_ids, before):
+    """Mark connected drivers not updated since the moment as stale, keep last_update."""
+    stmt = (
+        update(DriverTable)
+        .where(DriverTable.messenger_id.in_(messenger_ids))
+        .where(DriverTable.state == "connected")
+        .where(DriverTable.last_update < before)
+        .values(
+            state="stale", last_update=DriverTable.last_update, version=DriverTable.version + 1
+        )
+    )
+    return db.session.execute(stmt).rowcount
+
+
+def add_location_history(messenger_id, route, latitude, longitude, timestamp):
+    """Add driver location to history."""
+    db.session.execute(
+        _INSERT_HISTORY,
+        {
+            "messenger_id": messenger_id,
+            "route": route,
+            "latitude": latitude,
+            "longitude": longitude,
+            "timestamp": timestamp,
+        },
+    )
+
+
+def add_location_histories(rows):
+    """Add driver locations to history in bulk, rows are dicts of column values."""
+    db.session.execute(insert(LocationHistoryTable), rows)
+
+
+def find_location_history(after_id, limit):
+    """Select history locations added after id, in order of addition."""
+    stmt = (
+        select(LocationHistoryTable)
+        .where(LocationHistoryTable.id > after_id)
+        .order_by(LocationHistoryTable.id)
+        .limit(limit)
+    )
     return db.session.scalars(stmt).all()
 
 
-def update_driver_state(messenger_id, state):
-    """Update driver state."""
-    stmt = update(DriverTable).where(DriverTable.messenger_id == messenger_id).values(state=state)
-    db.session.execute(stmt)
+def find_last_location_history_id():
+    """Select id of the last history location, 0 for empty history."""
+    return db.session.scalar(select(func.max(LocationHistoryTable.id))) or 0
+
+
+def delete_location_history(before):
+    """Delete history locations older than timestamp."""
+    db.session.execute(delete(LocationHistoryTable).where(LocationHistoryTable.timestamp < before))
+
+
+def find_segment_times():
+    """Select all learned segment travel times."""
+    return db.session.scalars(select(SegmentTimeTable)).all()
+
+
+def save_segment_time(route, segment, bucket, duration, samples):
+    """Insert or update learned segment travel time."""
+    db.session.merge(
+        SegmentTimeTable(
+            route=route, segment=segment, bucket=bucket, duration=duration, samples=samples
+        )
+    )
@@ -0,0 +1,137 @@
+"""Request quota management."""
+
+import threading
+import time
+
+# Request priorities, lower value is more important
+PRIORITY_FORWARD = 0
+PRIORITY_REVERSE = 1
+PRIORITY_NAMES = {PRIORITY_FORWARD: "forward", PRIORITY_REVERSE: "reverse"}
+
+MINUTE = 60
+DAY = 24 * 60 * 60
+
+
+class TokenBucket:
+    """Token bucket refilled at ``capacity`` tokens per ``period`` seconds."""
+
+    def __init__(self, capacity, period):
+        """Create full bucket.
+
+        :param int capacity: Max number of tokens
+        :param float period: Seconds to refill empty bucket
+        """
+        self.capacity = capacity
+        self.period = period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    @property
+    def level(self):
+        """Get available tokens."""
+        self._refill()
+        return self._tokens
+
+    def take(self, reserve=0):
+        """Take one token if more than reserve tokens are left after that.
+
+        :param float reserve: Tokens that must stay in the bucket
+        :return bool: True if the token is taken
+        """
+        self._refill()
+        if self._tokens - 1 < reserve:
+            return False
+        self._tokens -= 1
+        return True
+
+    def give_back(self):
+        """Return a token taken for a request that has not been made."""
+        self._tokens = min(self._tokens + 1, self.capacity)
+
+    def drain(self):
+        """Empty the bucket, e.g. when the service reports exceeded quota."""
+        self._refill()
+        self._tokens = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.capacity / self.period
+        )
+        self._updated = now
+
+
+class QuotaManager:
+    """Per-minute and per-day request budget of one service endpoint.
+
+    A request takes a token from both buckets. Low priority requests are shed
+    first: they are granted only while every bucket keeps ``reserve`` share of
+    its capacity, the reserve is left for high priority requests.
+    A limit of 0 disables the corresponding bucket.
+    """
+
+    def __init__(self, per_minute=0, per_day=0, reserve=0.2):
+        """Create manager with full buckets.
+
+        :param int per_minute: Requests per minute, 0 for no limit
+        :param int per_day: Requests per day, 0 for no limit
+        :param float reserve: Share of budget kept for high priority requests
+        """
+        self.reserve = reserve
+        self._buckets = {}
+        if per_minute:
+            self._buckets["minute"] = TokenBucket(per_minute, MINUTE)
+        if per_day:
+            self._buckets["day"] = TokenBucket(per_day, DAY)
+        self._counters = {"granted": {}, "shed": {}}
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=PRIORITY_FORWARD):
+        """Take budget for one request.
+
+        :param int priority: Request priority
+        :return bool: True if the request may be made
+        """
+        with self._lock:
+            taken = []
+            for bucket in self._buckets.values():
+                reserve = bucket.capacity * self.reserve if priority > PRIORITY_FORWARD else 0
+                if not bucket.take(reserve):
+                    for granted in taken:
+                        granted.give_back()
+                    self._count("shed", priority)
+                    return False
+                taken.append(bucket)
+            self._count("granted", priority)
+            return True
+
+    def release(self):
+        """Return budget of an acquired request that has not been made."""
+        with self._lock:
+            for bucket in self._buckets.values():
+                bucket.give_back()
+
+    def exhausted(self):
+        """Stop requests until minute budget refills, the service refused with rate limit."""
+        with self._lock:
+            if "minute" in self._buckets:
+                self._buckets["minute"].drain()
+
+    def stats(self):
+        """Get budget usage.
+
+        :return dict: capacity and available tokens per bucket,
+                      granted and shed requests per priority
+        """
+        with self._lock:
+            result = {
+                name: {"capacity": bucket.capacity, "available": int(bucket.level)}
+                for name, bucket in self._buckets.items()
+            }
+            result["granted"] = dict(self._counters["granted"])
+            result["shed"] = dict(self._counters["shed"])
+            return result
+
+    def _count(self, name, priority):
+        label = PRIORITY_NAMES.get(priority, str(priority))
+        self._counters[name][label] = self._counters[name].get(label, 0) + 1
@@ -1,13 +1,36 @@
 """Openrouteservice client."""
 
+import functools
 import json
 import logging
+import os
+import threading
+import time
+import types
+from concurrent import futures
 
+import numpy as np
 import openrouteservice
+import requests
 from openrouteservice import exceptions
+from requests import adapters
+
+from transport_bot.api_service.breaker import OPEN, CircuitBreaker
+from transport_bot.api_service.cache import RouteCache
+from transport_bot.api_service.distance import haversine_many_to_many
+from transport_bot.api_service.geo import GridIndex
+from transport_bot.api_service.polyline import RouteLine, decode, encode
+from transport_bot.api_service.quota import PRIORITY_FORWARD, QuotaManager
 
 logger = logging.getLogger(__name__)
 
+# Max number of points of one ORS directions request
+ORS_MAX_WAYPOINTS = 50
+# Driver this far past the stop along the route is still at the stop, km
+AT_STOP_DISTANCE = 0.05
+# Max ORS requests waiting for a worker, per worker; further requests are shed
+QUEUE_PER_WORKER = 4
+
 
 class _RouteData:
     """Route data: stops and routes.
@@ -33,14 +56,27 @@ class _RouteData:
                         "<stop_key_1>",
                         "<stop_key_2>",
                         ....
-                    ]
+                    ],
+                    "geometry": str or list  # optional
                 }
             }
         }
+
+    Route geometry is the road line the route follows: Google encoded polyline
+    (as returned by ORS) or list of [lat, lon]. Without geometry the route is
+    approximated with straight lines between stops until load_geometries is called.
+    A route whose first and last stops are the same is circular.
     """
 
     def __init__(self):
         self._routes = None
+        self.stop_routes = types.MappingProxyType({})
+        self.stop_route_list = types.MappingProxyType({})
+        self.route_stop_positions = types.MappingProxyType({})
+        self.stop_index = GridIndex()
+        self.route_lines = types.MappingProxyType({})
+        self.route_stop_offsets = types.MappingProxyType({})
+        self.route_segments = types.MappingProxyType({})
 
     def load_from_json(self, path):
         """Load data from json file with route-format.
@@ -49,11 +85,281 @@ class _RouteData:
         :raises Exception: on wrong stop data
         """
         with open(path, encoding="utf-8") as f:
-            self._routes = json.load(f)
-        for name, route in self._routes["routes"].items():
+            routes = json.load(f)
+        for name, route in routes["routes"].items():
             for stop in route["stops"]:
-                if stop not in self._routes["stops"]:
+                if stop not in routes["stops"]:
                     raise Exception(f'Stop "{stop}" for route "{name}" not defined')
+        self._routes = routes
+        self._build_indexes()
+        self.route_segments = types.MappingProxyType({})
+        lines = {}
+        for key, route in routes["routes"].items():
+            geometry = route.get("geometry")
+            if isinstance(geometry, str):
+                lines[key] = RouteLine(decode(geometry))
+            elif geometry:
+                lines[key] = RouteLine(geometry)
+            else:
+                lines[key] = self._straight_line(key)
+        self._set_lines(lines)
+
+    def load_geometries(self, fetch, path=None):
+        """Replace straight line approximations with road geometry.
+
+        Geometry of every route without one in json is taken from the file cache
+        or fetched. Fetched geometry is stored in the cache, so the routes are
+        requested once, not on every start.
+
+        :param callable fetch: Get road line through points: list of (lat, lon)
+                               -> list of (lat, lon) or None on error
+        :param str path: Json file to cache fetched geometry, None to fetch on every call
+        """
+        cached = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                cached = json.load(f)
+        lines = dict(self.route_lines)
+        changed = False
+        for key, route in self._routes["routes"].items():
+            if route.get("geometry") or not route["stops"]:
+                continue
+            entry = cached.get(key)
+            if entry is None or entry["stops"] != route["stops"]:
+                points = fetch([self._stop_point(stop) for stop in route["stops"]])
+                if not points:
+                    logger.warning("No geometry for route %s, using straight lines", key)
+                    continue
+                entry = cached[key] = {"stops": route["stops"], "geometry": encode(points)}
+                changed = True
+            lines[key] = RouteLine(decode(entry["geometry"]))
+        self._set_lines(lines)
+        if path and changed:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(cached, f)
+
+    def load_segments(self, path):
+        """Load precomputed travel times between consecutive route stops.
+
+        File format (see the segments command):
+            {
+                "segments": [
+                    {
+                        "from": "<stop_key>",
+                        "to": "<stop_key>",
+                        "from_location": [lat, lon],
+                        "to_location": [lat, lon],
+                        "duration": float,  # seconds
+                        "distance": float,  # meters
+                    },
+                    ...
+                ]
+            }
+
+        Segments whose stop locations have changed since they were computed are
+        ignored. Only routes with all segments known use them.
+
+        :param str path: Json file
+        """
+        with open(path, encoding="utf-8") as f:
+            segments = {
+                (segment["from"], segment["to"]): segment for segment in json.load(f)["segments"]
+            }
+        route_segments = {}
+        for key, route in self._routes["routes"].items():
+            durations, distances = [0.0], [0.0]
+            for pair in self.consecutive_pairs(key):
+                segment = segments.get(pair)
+                if segment is None or (
+                    tuple(segment["from_location"]) != self._stop_point(pair[0])
+                    or tuple(segment["to_location"]) != self._stop_point(pair[1])
+                ):
+                    logger.warning("No segment %s -> %s for route %s", *pair, key)
+                    break
+                durations.append(durations[-1] + segment["duration"])
+                distances.append(distances[-1] + segment["distance"] / 1000)
+            else:
+                if len(route["stops"]) > 1:
+                    route_segments[key] = (
+                        np.array(durations, dtype=np.float64),
+                        np.array(distances, dtype=np.float64),
+                    )
+        self.route_segments = types.MappingProxyType(route_segments)
+
+    def consecutive_pairs(self, route):
+        """Get consecutive stop pairs of the route.
+
+        :param str route: Route key
+        :return list: of tuple(from_stop, to_stop)
+        """
+        stops = self._routes["routes"][route]["stops"]
+        return list(zip(stops, stops[1:]))
+
+    def along_route(
+        self, route, stop, latitudes, longitudes, max_off_route, segment_durations=None
+    ):
+        """Get distances and durations along the route from points to the stop.
+
+        Points are projected onto the route line. A point that has passed the
+        stop does not reach it, unless the route is circular and it reaches
+        the stop on the next lap.
+        Distance and duration are the remaining part of the current segment plus
+        the sum of the next segments up to the stop. Segment distances are taken
+        from precomputed segments, otherwise from the route line. Segment durations
+        are given or taken from precomputed segments, otherwise they are unknown.
+
+        :param str route: Route key
+        :param str stop: Stop key of the route
+        :param latitudes: Point latitudes
+        :param longitudes: Point longitudes
+        :param float max_off_route: Max distance in km from point to route line
+        :param segment_durations: Seconds to pass every segment between consecutive stops,
+                                  None to use precomputed segments
+        :return tuple: (distances, durations) arrays: km, inf for points off route or
+                       past the stop, and seconds, nan if unknown
+        """
+        line = self.route_lines[route]
+        offsets, off_route = line.locate(latitudes, longitudes)
+        stop_offsets = np.array(self.route_stop_offsets[route], dtype=np.float64)
+        positions = np.array(self.route_stop_positions[route][stop], dtype=np.intp)
+        remaining = stop_offsets[positions][None, :] - offsets[:, None]
+        passed = remaining < -AT_STOP_DISTANCE
+        stops = self._routes["routes"][route]["stops"]
+        circular = len(stops) > 1 and stops[0] == stops[-1]
+        if circular:
+            remaining = np.where(passed, remaining + stop_offsets[-1] - stop_offsets[0], remaining)
+        else:
+            remaining = np.where(passed, np.inf, remaining)
+        best = remaining.argmin(axis=1)
+        rows = np.arange(len(offsets))
+        distances = np.maximum(remaining[rows, best], 0)
+        unreachable = (off_route > max_off_route) | ~np.isfinite(distances)
+        distances[unreachable] = np.inf
+        durations = np.full(len(offsets), np.nan)
+        segments = self.route_segments.get(route)
+        if segment_durations is not None:
+            cum_durations = np.concatenate(([0.0], np.cumsum(segment_durations)))
+        elif segments is not None:
+            cum_durations = segments[0]
+        else:
+            return distances, durations
+
+        # Point is in segment k between stops k and k + 1
+        k = np.clip(np.searchsorted(stop_offsets, offsets, side="right") - 1, 0, len(stops) - 2)
+        lengths = stop_offsets[k + 1] - stop_offsets[k]
+        fraction = np.where(
+            lengths > 0,
+            np.clip((stop_offsets[k + 1] - offsets) / np.maximum(lengths, 1e-9), 0, 1),
+            0,
+        )
+        target = positions[best]
+        laps = passed[rows, best] if circular else np.zeros(len(offsets), dtype=bool)
+        totals = [(cum_durations, durations)]
+        if segments is not None:
+            totals.append((segments[1], distances))
+        for cumulative, result in totals:
+            total = (
+                fraction * (cumulative[k + 1] - cumulative[k])
+                + cumulative[target]
+                - cumulative[k + 1]
+                + laps * cumulative[-1]
+            )
+            result[:] = np.maximum(total, 0)
+        distances[unreachable] = np.inf
+        durations[unreachable] = np.nan
+        return distances, durations
+
+    def _build_indexes(self):
+        """Build read-only lookup indexes over loaded stops and routes.
+
+        stop_routes: stop key -> frozenset of route keys passing through the stop
+        stop_route_list: stop key -> tuple of {"key", "name"} sorted by route key
+        route_stop_positions: route key -> {stop key -> tuple of positions in route}
+        stop_index: spatial index of stop locations
+        """
+        stop_routes = {stop: set() for stop in self._routes["stops"]}
+        route_stop_positions = {}
+        for key, route in self._routes["routes"].items():
+            positions = {}
+            for position, stop in enumerate(route["stops"]):
+                positions.setdefault(stop, []).append(position)
+                stop_routes[stop].add(key)
+            route_stop_positions[key] = types.MappingProxyType(
+                {stop: tuple(p) for stop, p in positions.items()}
+            )
+        self.stop_routes = types.MappingProxyType(
+            {stop: frozenset(keys) for stop, keys in stop_routes.items()}
+        )
+        self.stop_route_list = types.MappingProxyType(
+            {
+                stop: tuple(
+                    {"key": key, "name": self._routes["routes"][key]["name"]}
+                    for key in sorted(keys)
+                )
+                for stop, keys in stop_routes.items()
+            }
+        )
+        self.route_stop_positions = types.MappingProxyType(route_stop_positions)
+        self.stop_index = GridIndex()
+        for stop, data in self._routes["stops"].items():
+            self.stop_index.insert(stop, data["location"]["lat"], data["location"]["lon"])
+
+    def _set_lines(self, lines):
+        """Set route lines and offsets of route stops along them.
+
+        Stops are projected in route order, each at or after the previous one,
+        so a line passing a place twice gets the right position for each visit.
+        """
+        stop_offsets = {}
+        for key, route in self._routes["routes"].items():
+            offsets = []
+            start = 0.0
+            for stop in route["stops"]:
+                lat, lon = self._stop_point(stop)
+                (start,), _ = lines[key].locate([lat], [lon], start)
+                offsets.append(float(start))
+            stop_offsets[key] = tuple(offsets)
+        self.route_lines = types.MappingProxyType(lines)
+        self.route_stop_offsets = types.MappingProxyType(stop_offsets)
+
+    def _straight_line(self, route):
+        points = [self._stop_point(stop) for stop in self._routes["routes"][route]["stops"]]
+        return RouteLine(points or [(0.0, 0.0)], approximate=True)
+
+    def _stop_point(self, stop):
+        location = self._routes["stops"][stop]["location"]
+        return location["lat"], location["lon"]
+
+    def nearest_stops(self, latitude, longitude, count):
+        """Get stops nearest to the point.
+
+        :param float latitude: Point latitude
+        :param float longitude: Point longitude
+        :param int count: Max number of stops
+        :return list: of tuple(distance_km, stop_key) ordered by distance
+        """
+        return self.stop_index.nearest(latitude, longitude, count)
+
+    def route_distances(self, latitude, longitude):
+        """Get distance from the point to the nearest stop of every route.
+
+        Stops are visited in order of distance, so the search ends once the
+        nearest stop of every route has been seen.
+
+        :param float latitude: Point latitude
+        :param float longitude: Point longitude
+        :return list: of tuple(distance_km, route_key) ordered by distance
+        """
+        result = {key: 0 for key, route in self._routes["routes"].items() if not route["stops"]}
+        pending = len(self._routes["routes"]) - len(result)
+        nearest = self.stop_index.iter_nearest(latitude, longitude)
+        while pending:
+            distance, stop = next(nearest)
+            for key in self.stop_routes[stop]:
+                if key not in result:
+                    result[key] = distance
+                    pending -= 1
+        return sorted((distance, key) for key, distance in result.items())
 
     def __getitem__(self, name):
         return self._routes[name]
@@ -68,13 +374,156 @@ class _RouteClient:
 
     def __init__(self):
         self.client = None
+        self.cache = RouteCache()
+        self.use_matrix = True
+        self.deadline = None
+        self.breaker = CircuitBreaker()
+        self.detour_factor = 1.3
+        self.average_speed = 20
+        self.quotas = {"directions": QuotaManager(), "matrix": QuotaManager()}
+        self._executor = futures.ThreadPoolExecutor(thread_name_prefix="ors")
+        self._max_pending = 8 * (QUEUE_PER_WORKER + 1)
+        self._pending = 0
+        self._shed = 0
+        self._pending_lock = threading.Lock()
 
-    def set_config(self, open_route_service_key):
+    def set_config(
+        self,
+        open_route_service_key,
+        cache_grid=25,
+        cache_ttl=300,
+        cache_size=10000,
+        cache_path=None,
+        use_matrix=True,
+        workers=8,
+        deadline=0.8,
+        breaker_error_rate=0.5,
+        breaker_latency=2.0,
+        breaker_cooldown=30,
+        detour_factor=1.3,
+        average_speed=20,
+        directions_per_minute=40,
+        directions_per_day=2000,
+        matrix_per_minute=40,
+        matrix_per_day=500,
+        base_url=None,
+    ):
         """Set configuration.
 
         :param str open_route_service_key: See https://openrouteservice.org/dev/#/api-docs
+        :param float cache_grid: Route cache coordinates grid in meters
+        :param float cache_ttl: Route cache entry lifetime in seconds
+        :param int cache_size: Route cache max entries in memory
+        :param str cache_path: Route cache SQLite file, None for memory only cache
+        :param bool use_matrix: Request many routes at once with ORS matrix API
+        :param int workers: Max number of concurrent ORS requests
+        :param float deadline: Time budget in seconds for routes of one passenger request,
+                               None for no limit
+        :param float breaker_error_rate: Share of failed ORS calls that opens circuit breaker
+        :param float breaker_latency: Seconds after which ORS call counts as failed
+        :param float breaker_cooldown: Seconds circuit breaker stays open
+        :param float detour_factor: Ratio of road distance to straight line distance
+                                    for local estimates
+        :param float average_speed: Average speed in km/h for local estimates
+        :param int directions_per_minute: ORS directions quota per minute, 0 for no limit
+        :param int directions_per_day: ORS directions quota per day, 0 for no limit
+        :param int matrix_per_minute: ORS matrix quota per minute, 0 for no limit
+        :param int matrix_per_day: ORS matrix quota per day, 0 for no limit
+        :param str base_url: ORS API url, None for https://api.openrouteservice.org
+        """
+        # Do not wait for quota to recover, the request is shed instead.
+        kwargs = {"base_url": base_url} if base_url else {}
+        # A call slower than the breaker latency or the passenger deadline is of no use,
+        # do not let it hold a worker longer, including retries of 503 responses.
+        timeout = max(breaker_latency, deadline or 0)
+        self.client = openrouteservice.Client(
+            key=open_route_service_key,
+            timeout=timeout,
+            retry_timeout=timeout,
+            retry_over_query_limit=False,
+            **kwargs,
+        )
+        # Keep-alive connections shared by all workers.
+        adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.client._session.mount("https://", adapter)  # pylint: disable=protected-access
+        self.client._session.mount("http://", adapter)  # pylint: disable=protected-access
+        self._executor.shutdown(wait=False)
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ors")
+        self._max_pending = workers * (QUEUE_PER_WORKER + 1)
+        self.use_matrix = use_matrix
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(
+            error_rate=breaker_error_rate, latency=breaker_latency, cooldown=breaker_cooldown
+        )
+        self.detour_factor = detour_factor
+        self.average_speed = average_speed
+        self.quotas = {
+            "directions": QuotaManager(directions_per_minute, directions_per_day),
+            "matrix": QuotaManager(matrix_per_minute, matrix_per_day),
+        }
+        self.cache = RouteCache(
+            grid_meters=cache_grid, ttl=cache_ttl, max_size=cache_size, path=cache_path
+        )
+
+    def new_deadline(self):
+        """Get deadline for routes of one passenger request.
+
+        :return float: time.monotonic() based deadline or None for no limit
+        """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def available(self):
+        """Check whether ORS requests are made now.
+
+        :return bool: False while circuit breaker is open
+        """
+        return self.breaker.state != OPEN
+
+    def get_stats(self):
+        """Get client counters.
+
+        :return dict: with cache hit/miss counters, circuit breaker state, quota usage,
+                      requests running or waiting for a worker and shed requests
+        """
+        return {
+            "cache": self.cache.stats(),
+            "breaker": self.breaker.stats(),
+            "quota": {name: quota.stats() for name, quota in self.quotas.items()},
+            "queue": {"pending": self._pending, "shed": self._shed},
+        }
+
+    def estimate_matrix_info(self, sources, destinations):
+        """Estimate route summaries locally, without ORS.
+
+        Distance is straight line distance multiplied by detour factor,
+        duration is the distance at average speed.
+
+        :param list sources: tuple(latitude, longitude) of route origins
+        :param list destinations: tuple(latitude, longitude) of route destinations
+        :return list: row of summaries dict(duration=float, distance=float, approximate=True)
+                      per source
         """
-        self.client = openrouteservice.Client(key=open_route_service_key)
+        if not sources or not destinations:
+            return [[] for _ in sources]
+        distances = haversine_many_to_many(
+            [lat for lat, _ in sources],
+            [lon for _, lon in sources],
+            [lat for lat, _ in destinations],
+            [lon for _, lon in destinations],
+        )
+        distances = distances * self.detour_factor
+        return [
+            [
+                dict(
+                    _summary(distance / self.average_speed * 3600, distance * 1000),
+                    approximate=True,
+                )
+                for distance in row
+            ]
+            for row in distances.tolist()
+        ]
 
     def get_ors_route_info(
         self,
@@ -82,6 +531,7 @@ class _RouteClient:
         from_longitude,
         to_latitude,
         to_longitude,
+        priority=PRIORITY_FORWARD,
     ):
         """Get route summary: duration and distance.
 
@@ -89,30 +539,252 @@ class _RouteClient:
         :param float from_longitude: driver longitude
         :param float to_latitude: stop latitude
         :param float to_longitude: stop longitude
+        :param int priority: Request priority for ORS quota
         :return dict(duration=float, distance=float})
         """
-        coords = (
-            (from_longitude, from_latitude),
-            (to_longitude, to_latitude),
-        )
+        cache_key = self.cache.key(from_latitude, from_longitude, to_latitude, to_longitude)
+        summary = self.cache.get(cache_key)
+        if summary is None:
+            summary = self._request_directions(
+                from_latitude, from_longitude, to_latitude, to_longitude, priority
+            )
+            if summary is not None:
+                self.cache.put(cache_key, summary)
+        return summary
+
+    def get_ors_route_geometry(self, points):
+        """Get road line through points.
+
+        Long routes are requested in parts of ORS_MAX_WAYPOINTS points.
+
+        :param list points: tuple(latitude, longitude) of waypoints
+        :return list: tuple(latitude, longitude) of line vertices or None on ORS error
+        """
+        line = []
+        step = ORS_MAX_WAYPOINTS - 1
+        for begin in range(0, max(len(points) - 1, 1), step):
+            end = begin + step + 1
+            coords = [(lon, lat) for lat, lon in points[begin:end]]
+            data = self._request("directions", PRIORITY_FORWARD, self.client.directions, coords)
+            if not data:
+                return None
+            part = decode(data["routes"][0]["geometry"])
+            line.extend(part[1:] if line else part)
+        return line
+
+    def get_ors_segments(self, pairs):
+        """Get exact route durations and distances between point pairs.
+
+        Pairs are requested with ORS matrix API, ORS_MAX_WAYPOINTS points per
+        request, bypassing the route cache.
+
+        :param list pairs: tuple(from_point, to_point) of tuple(latitude, longitude)
+        :return list: tuple(duration_seconds, distance_meters) per pair, None for pairs
+                      that are not received
+        """
+        result = []
+        step = ORS_MAX_WAYPOINTS // 2
+        for begin in range(0, len(pairs), step):
+            end = begin + step
+            chunk = pairs[begin:end]
+            locations = [(lon, lat) for (lat, lon), _ in chunk]
+            locations += [(lon, lat) for _, (lat, lon) in chunk]
+            data = self._request(
+                "matrix",
+                PRIORITY_FORWARD,
+                self.client.distance_matrix,
+                locations,
+                sources=list(range(len(chunk))),
+                destinations=list(range(len(chunk), len(locations))),
+                metrics=["distance", "duration"],
+            )
+            received = data and "durations" in data and "distances" in data
+            for i in range(len(chunk)):
+                segment = None
+                # Unreachable pairs are null in the matrix.
+                if received and None not in (data["durations"][i][i], data["distances"][i][i]):
+                    segment = (data["durations"][i][i], data["distances"][i][i])
+                result.append(segment)
+        return result
+
+    def get_ors_matrix_info(self, sources, destinations, deadline=None, priority=PRIORITY_FORWARD):
+        """Get route summaries for every source and destination pair.
+
+        Cached pairs are taken from the cache, the others are requested at once
+        with ORS matrix API. When the matrix API is disabled or fails, falls back
+        to directions requests per pair made concurrently.
+        Requests still running at the deadline are left to complete in background,
+        their results go to the cache.
+
+        :param list sources: tuple(latitude, longitude) of route origins
+        :param list destinations: tuple(latitude, longitude) of route destinations
+        :param float deadline: time.monotonic() based deadline, None for no limit
+        :param int priority: Request priority for ORS quota, requests are made in order
+                             of sources and destinations, so put the most valuable first
+        :return list: row of summaries dict(duration=float, distance=float) per source,
+                      None for routes that are not found or not received in time
+        """
+        result = [[None] * len(destinations) for _ in sources]
+        missing = []
+        for i, source in enumerate(sources):
+            for j, destination in enumerate(destinations):
+                cache_key = self.cache.key(*source, *destination)
+                result[i][j] = self.cache.get(cache_key)
+                if result[i][j] is None:
+                    missing.append((i, j, cache_key))
+        if not missing:
+            return result
+
+        summaries = None
+        if self.use_matrix:
+            future = self._submit(self._request_matrix, sources, destinations, missing, priority)
+            if future:
+                future.add_done_callback(functools.partial(self._cache_matrix, missing))
+                done, _ = futures.wait([future], timeout=_remaining(deadline))
+                if done:
+                    summaries = future.result()
+        if summaries is None and _remaining(deadline) != 0:
+            pairs = {}
+            for i, j, cache_key in missing:
+                future = self._submit(
+                    self._request_directions, *sources[i], *destinations[j], priority
+                )
+                if not future:
+                    break
+                future.add_done_callback(functools.partial(self._cache_directions, cache_key))
+                pairs[future] = (i, j)
+            done, _ = futures.wait(pairs, timeout=_remaining(deadline))
+            summaries = {pairs[future]: future.result() for future in done}
+        for i, j, _ in missing:
+            result[i][j] = (summaries or {}).get((i, j))
+        return result
+
+    def _submit(self, fn, *args):
+        """Run function in a worker unless too many requests are waiting.
+
+        :return concurrent.futures.Future: or None if the request is shed
+        """
+        with self._pending_lock:
+            if self._pending >= self._max_pending:
+                self._shed += 1
+                return None
+            self._pending += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._pending_lock:
+            self._pending -= 1
+
+    def _cache_directions(self, cache_key, future):
+        summary = future.result()
+        if summary is not None:
+            self.cache.put(cache_key, summary)
+
+    def _cache_matrix(self, missing, future):
+        summaries = future.result()
+        if summaries is not None:
+            for i, j, cache_key in missing:
+                if (i, j) in summaries:
+                    self.cache.put(cache_key, summaries[(i, j)])
+
+    def _request(self, name, priority, method, *args, **kwargs):
+        """Call ORS client method guarded by quota and circuit breaker.
+
+        :return dict: ORS response or None on any ORS error
+        """
+        quota = self.quotas[name]
+        if not quota.acquire(priority):
+            logger.warning("ORS %s skipped: quota exceeded", name)
+            return None
+        if not self.breaker.allow():
+            quota.release()
+            logger.debug("ORS %s skipped: circuit breaker is open", name)
+            return None
         data = None
+        success = False
+        started = time.monotonic()
         try:
-            data = self.client.directions(coords)
+            data = method(*args, **kwargs)
+            success = True
         except exceptions.ApiError as e:
-            logger.error("ORS ApiError: %s", e)
+            logger.error("ORS %s ApiError: %s", name, e)
+            if e.status == 429:
+                quota.exhausted()
+            # Client errors (like unroutable points) do not mean that ORS is down.
+            success = e.status != 429 and 400 <= e.status < 500
         except exceptions.Timeout as e:
-            logger.error("ORS Timeout: %s", e)
+            logger.error("ORS %s Timeout: %s", name, e)
         except exceptions.HTTPError as e:
-            logger.error("ORS HTTPError: %s", e)
+            logger.error("ORS %s HTTPError: %s", name, e)
+        except requests.exceptions.ConnectionError as e:
+            logger.error("ORS %s ConnectionError: %s", name, e)
+            # Not received by ORS
+            quota.release()
+        except requests.exceptions.RequestException as e:
+            logger.error("ORS %s RequestException: %s", name, e)
+        finally:
+            # Also ends a half-open probe that raised an unexpected error
+            self.breaker.record(success, time.monotonic() - started)
+        return data
+
+    def _request_directions(
+        self, from_latitude, from_longitude, to_latitude, to_longitude, priority
+    ):
+        coords = (
+            (from_longitude, from_latitude),
+            (to_longitude, to_latitude),
+        )
+        data = self._request("directions", priority, self.client.directions, coords)
 
         # Skip if received any ORS error.
         if not data:
             return None
-        summary = {
-            "duration": round(data["routes"][0]["summary"].get("duration", 0) / 60),
-            "distance": round(data["routes"][0]["summary"].get("distance", 0) / 1000, 2),
-        }
-        return summary
+        return _summary(
+            data["routes"][0]["summary"].get("duration", 0),
+            data["routes"][0]["summary"].get("distance", 0),
+        )
+
+    def _request_matrix(self, sources, destinations, missing, priority):
+        rows = sorted({i for i, _, _ in missing})
+        cols = sorted({j for _, j, _ in missing})
+        locations = [(sources[i][1], sources[i][0]) for i in rows]
+        locations += [(destinations[j][1], destinations[j][0]) for j in cols]
+        data = self._request(
+            "matrix",
+            priority,
+            self.client.distance_matrix,
+            locations,
+            sources=list(range(len(rows))),
+            destinations=list(range(len(rows), len(locations))),
+            metrics=["distance", "duration"],
+        )
+
+        # Fall back to directions if received any ORS error.
+        if not data or "durations" not in data or "distances" not in data:
+            return None
+        summaries = {}
+        for row, i in enumerate(rows):
+            for col, j in enumerate(cols):
+                duration = data["durations"][row][col]
+                distance = data["distances"][row][col]
+                # Unreachable pairs are null in the matrix.
+                if duration is not None and distance is not None:
+                    summaries[(i, j)] = _summary(duration, distance)
+        return summaries
+
+
+def _remaining(deadline):
+    """Get seconds left before deadline, None for no deadline."""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _summary(duration, distance):
+    """Convert ORS duration in seconds and distance in meters to route summary."""
+    return {"duration": round(duration / 60), "distance": round(distance / 1000, 2)}
 
 
 route_data = _RouteData()
@@ -0,0 +1,98 @@
+"""Request coalescing."""
+
+import threading
+import time
+
+PRUNE_SIZE = 1024
+
+
+class _Call:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one computation between identical concurrent calls.
+
+    The first caller of a key runs the computation, callers with the same key
+    arriving meanwhile wait for its result instead of computing it again.
+    The result is also reused by later callers for ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl=0):
+        """Create empty group.
+
+        :param float ttl: Seconds to reuse a result, 0 to share in-flight calls only
+        """
+        self.ttl = ttl
+        self._calls = {}
+        self._results = {}
+        self._lock = threading.Lock()
+        self._counters = {"computed": 0, "shared": 0, "reused": 0}
+
+    def set_config(self, ttl):
+        """Set configuration and forget stored results.
+
+        :param float ttl: Seconds to reuse a result, 0 to share in-flight calls only
+        """
+        with self._lock:
+            self.ttl = ttl
+            self._results.clear()
+
+    def do(self, key, fn):
+        """Get result of fn for key, computing it at most once at a time.
+
+        :param key: Hashable computation key
+        :param callable fn: Computation without arguments
+        :return: fn result
+        :raises Exception: fn error, also for callers waiting for it
+        """
+        with self._lock:
+            stored = self._results.get(key)
+            if stored is not None and stored[0] > time.monotonic():
+                self._counters["reused"] += 1
+                return stored[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters["computed"] += 1
+            else:
+                self._counters["shared"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.ttl:
+                    self._store(key, call.value)
+            call.done.set()
+        return call.value
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: computed, shared (waited for in-flight call) and reused results
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        if len(self._results) >= PRUNE_SIZE:
+            for stale in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                del self._results[stale]
+        self._results[key] = (now + self.ttl, value)
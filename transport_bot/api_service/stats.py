@@ -0,0 +1,30 @@
+"""Service statistics http api."""
+
+from transport_bot.api_service.board import arrival_board
+from transport_bot.api_service.common import resp
+from transport_bot.api_service.fleet import fleet_store
+from transport_bot.api_service.history import segment_model
+from transport_bot.api_service.hub import arrival_hub
+from transport_bot.api_service.passenger import nearest_driver_flight
+from transport_bot.api_service.route import route_client
+from transport_bot.api_service.schema import app
+from transport_bot.api_service.sweeper import sweeper
+
+
+@app.route("/service/stats", methods=["GET"])
+def get_stats():
+    """Get service counters.
+
+    :return Flask.Response: status=200 and json with counters of service components
+    """
+    return resp(
+        data={
+            "ors": route_client.get_stats(),
+            "nearest_driver": nearest_driver_flight.stats(),
+            "segments": segment_model.stats(),
+            "arrival_board": arrival_board.stats(),
+            "arrival_stream": arrival_hub.stats(),
+            "fleet": fleet_store.stats(),
+            "stale_drivers": sweeper.stats(),
+        }
+    )
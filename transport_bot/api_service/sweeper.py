@@ -0,0 +1,104 @@
+"""Background marking of silent drivers as stale."""
+
+import datetime
+import logging
+import threading
+
+from transport_bot.api_service import query
+from transport_bot.api_service.board import arrival_board
+from transport_bot.api_service.fleet import fleet_store
+from transport_bot.api_service.schema import db
+
+logger = logging.getLogger(__name__)
+
+
+class _Sweeper:
+    """Mark connected drivers that have not reported for ``silence`` seconds as stale.
+
+    A stale driver is no longer a candidate for passengers: it leaves the fleet
+    store indexes or, without the fleet store, the connected drivers query.
+    Its next location makes it connected again. Every run checks drivers least
+    recently updated first, ``batch`` at a time, and stops at the first fresh
+    driver, so a run costs the number of stale drivers, not the fleet size.
+    """
+
+    def __init__(self):
+        self.silence = 300
+        self.batch = 1000
+        self._counters = {"runs": 0, "stale": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def set_config(self, silence=300, batch=1000):
+        """Set configuration.
+
+        :param float silence: Seconds without updates after which a driver is stale
+        :param int batch: Max number of drivers marked at once
+        """
+        self.silence = silence
+        self.batch = batch
+
+    def sweep(self, now=None):
+        """Mark silent drivers as stale, call in application context.
+
+        :param datetime.datetime now: Local time, now by default
+        :return int: number of marked drivers
+        """
+        before = (now or datetime.datetime.now()) - datetime.timedelta(seconds=self.silence)
+        marked = 0
+        routes = set()
+        while True:
+            if fleet_store.enabled:
+                count, batch_routes = fleet_store.sweep(before, self.batch)
+            else:
+                rows = query.find_stale_drivers(before, self.batch)
+                if not rows:
+                    break
+                count = query.mark_drivers_stale([row.messenger_id for row in rows], before)
+                db.session.commit()
+                batch_routes = {row.route for row in rows}
+            marked += count
+            routes.update(batch_routes)
+            if count < self.batch:
+                break
+        for route in routes:
+            arrival_board.notify(route)
+        with self._lock:
+            self._counters["runs"] += 1
+            self._counters["stale"] += marked
+        return marked
+
+    def start(self, app, interval):
+        """Run sweeps in background thread.
+
+        :param flask.Flask app: Application to run sweeps in its context
+        :param float interval: Seconds between sweeps
+        """
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    with app.app_context():
+                        count = self.sweep()
+                    if count:
+                        logger.info("%s drivers are stale", count)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Stale driver sweep error")
+
+        threading.Thread(target=run, name="stale-sweeper", daemon=True).start()
+
+    def stop(self):
+        """Stop background sweeps."""
+        self._stop.set()
+
+    def stats(self):
+        """Get counters.
+
+        :return dict: runs and marked drivers
+        """
+        with self._lock:
+            return dict(self._counters)
+
+
+sweeper = _Sweeper()
@@ -0,0 +1,112 @@
+"""Recent positions of live drivers."""
+
+import array
+import math
+
+from transport_bot.api_service.distance import haversine_one_to_many
+
+# Slower drivers are standing, their heading is unknown
+MIN_SPEED = 3
+
+
+def bearing(latitude1, longitude1, latitude2, longitude2):
+    """Get initial bearing from the first point to the second one.
+
+    :return float: degrees clockwise from north in [0, 360)
+    """
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    delta = math.radians(longitude2 - longitude1)
+    x = math.sin(delta) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+class Trail:
+    """Ring buffer of the last (timestamp, latitude, longitude) samples of a driver.
+
+    Samples are kept in one flat array of doubles, so a trail of ``size``
+    samples takes about 56 bytes of object, 64 bytes of array header and
+    24 * size bytes of samples: 312 bytes for 8 samples.
+    """
+
+    __slots__ = ("_samples", "_next", "_count")
+
+    def __init__(self, size=8):
+        """Create empty trail.
+
+        :param int size: Max number of samples, at least 2
+        """
+        self._samples = array.array("d", bytes(24 * max(size, 2)))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        """Get number of samples."""
+        return self._count
+
+    @property
+    def size(self):
+        """Get max number of samples."""
+        return len(self._samples) // 3
+
+    def append(self, timestamp, latitude, longitude):
+        """Add sample replacing the oldest one, samples not newer than the last one are ignored.
+
+        :param float timestamp: Unix time in seconds
+        :param float latitude: Latitude
+        :param float longitude: Longitude
+        """
+        if self._count and timestamp <= self._samples[3 * ((self._next - 1) % self.size)]:
+            return
+        offset = 3 * self._next
+        self._samples[offset] = timestamp
+        self._samples[offset + 1] = latitude
+        self._samples[offset + 2] = longitude
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def samples(self):
+        """Get samples.
+
+        :return list: of tuple(timestamp, latitude, longitude), oldest first
+        """
+        size = self.size
+        first = (self._next - self._count) % size
+        result = []
+        for i in range(self._count):
+            offset = 3 * ((first + i) % size)
+            end = offset + 3
+            result.append(tuple(self._samples[offset:end]))
+        return result
+
+    def velocity(self):
+        """Get heading and speed between the oldest and the newest samples.
+
+        :return tuple: (heading degrees clockwise from north, speed km/h),
+                       None if there are less than two samples or the driver
+                       moves slower than MIN_SPEED
+        """
+        if self._count < 2:
+            return None
+        samples = self.samples()
+        (time1, lat1, lon1), (time2, lat2, lon2) = samples[0], samples[-1]
+        (distance,) = haversine_one_to_many(lat1, lon1, [lat2], [lon2]).tolist()
+        speed = distance / (time2 - time1) * 3600
+        if speed < MIN_SPEED:
+            return None
+        return bearing(lat1, lon1, lat2, lon2), speed
+
+    def approaching(self, latitude, longitude):
+        """Check whether the driver moves towards the point.
+
+        :param float latitude: Point latitude
+        :param float longitude: Point longitude
+        :return bool: True if the heading differs from the bearing to the point
+                      by less than 90 degrees, None if the heading is unknown
+        """
+        velocity = self.velocity()
+        if velocity is None:
+            return None
+        _, last_lat, last_lon = self.samples()[-1]
+        difference = abs(velocity[0] - bearing(last_lat, last_lon, latitude, longitude)) % 360
+        return min(difference, 360 - difference) < 90
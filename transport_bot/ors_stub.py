@@ -0,0 +1,161 @@
+"""Local openrouteservice stand-in for load testing.
+
+Serves directions and matrix endpoints with routes computed from straight line
+distance, with configurable latency, error rate and rate limit.
+"""
+
+import math
+import random
+import threading
+import time
+
+import click
+import click_config_file
+from flask import Flask, jsonify, request
+
+from .api_service import polyline
+from .api_service.distance import haversine_many_to_many
+from .api_service.quota import MINUTE, TokenBucket
+
+
+class Latency:
+    """Response latency distribution.
+
+    Formats:
+        "<seconds>" — constant,
+        "uniform:<min>:<max>" — uniform between min and max seconds,
+        "lognormal:<median>:<sigma>" — log-normal with median seconds and sigma.
+    """
+
+    def __init__(self, spec, rnd=None):
+        """Parse latency distribution.
+
+        :param str spec: Distribution specification
+        :param random.Random rnd: Random generator
+        :raises ValueError: on unknown format
+        """
+        self.spec = spec
+        self._rnd = rnd or random.Random()
+        name, *args = str(spec).split(":")
+        if not args:
+            value = float(name)
+            self._sample = lambda: value
+        elif name == "uniform" and len(args) == 2:
+            low, high = (float(a) for a in args)
+            self._sample = lambda: self._rnd.uniform(low, high)
+        elif name == "lognormal" and len(args) == 2:
+            median, sigma = (float(a) for a in args)
+            self._sample = lambda: self._rnd.lognormvariate(math.log(median), sigma)
+        else:
+            raise ValueError(f"Unknown latency: {spec}")
+
+    def sample(self):
+        """Get latency in seconds."""
+        return max(self._sample(), 0)
+
+
+def create_app(
+    latency="0", error_rate=0, rate_limit=0, detour_factor=1.3, average_speed=30, seed=None
+):
+    """Create stand-in application.
+
+    :param str latency: Latency distribution, see Latency
+    :param float error_rate: Share of requests answered with HTTP 500
+    :param int rate_limit: Requests per minute answered before HTTP 429, 0 for no limit
+    :param float detour_factor: Ratio of route distance to straight line distance
+    :param float average_speed: Speed in km/h to compute route duration
+    :param int seed: Random seed for reproducible runs
+    :return Flask: application
+    """
+    app = Flask(__name__)
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+    delay = Latency(latency, rnd)
+    bucket = TokenBucket(rate_limit, MINUTE) if rate_limit else None
+    app.config["ORS_STUB_COUNTERS"] = counters = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    def failure():
+        with lock:
+            counters["requests"] += 1
+            pause = delay.sample()
+            limited = bucket is not None and not bucket.take()
+            failed = not limited and rnd.random() < error_rate
+            if limited:
+                counters["rate_limited"] += 1
+            elif failed:
+                counters["errors"] += 1
+        time.sleep(pause)
+        if limited:
+            return jsonify({"error": "Rate limit exceeded"}), 429
+        if failed:
+            return jsonify({"error": {"code": 2099, "message": "Unknown internal error"}}), 500
+        return None
+
+    def routes(sources, destinations):
+        distances = haversine_many_to_many(
+            [lat for lat, _ in sources],
+            [lon for _, lon in sources],
+            [lat for lat, _ in destinations],
+            [lon for _, lon in destinations],
+        )
+        distances = distances * detour_factor * 1000
+        durations = distances / (average_speed / 3.6)
+        return distances.round(2).tolist(), durations.round(2).tolist()
+
+    @app.route("/v2/directions/<profile>/json", methods=["POST"])
+    def directions(profile):
+        error = failure()
+        if error:
+            return error
+        points = [(lat, lon) for lon, lat in request.json["coordinates"]]
+        distance, duration = 0, 0
+        for start, end in zip(points, points[1:]):
+            distances, durations = routes([start], [end])
+            distance += distances[0][0]
+            duration += durations[0][0]
+        summary = {"distance": round(distance, 1), "duration": round(duration, 1)}
+        return jsonify({"routes": [{"summary": summary, "geometry": polyline.encode(points)}]})
+
+    @app.route("/v2/matrix/<profile>/json", methods=["POST"])
+    def matrix(profile):
+        error = failure()
+        if error:
+            return error
+        locations = [(lat, lon) for lon, lat in request.json["locations"]]
+        sources = request.json.get("sources") or range(len(locations))
+        destinations = request.json.get("destinations") or range(len(locations))
+        distances, durations = routes(
+            [locations[i] for i in sources], [locations[j] for j in destinations]
+        )
+        metrics = request.json.get("metrics") or ["duration"]
+        data = {}
+        if "duration" in metrics:
+            data["durations"] = durations
+        if "distance" in metrics:
+            data["distances"] = distances
+        return jsonify(data)
+
+    @app.route("/stats", methods=["GET"])
+    def stats():
+        with lock:
+            return jsonify(counters)
+
+    return app
+
+
+@click.command()
+@click.option("--bind-port", "bind_port", type=int, default=8080, help="Bind port")
+@click.option("--latency", "latency", type=str, default="0", help="Latency distribution")
+@click.option("--error-rate", "error_rate", type=float, default=0, help="Share of HTTP 500")
+@click.option("--rate-limit", "rate_limit", type=int, default=0, help="Requests per minute")
+@click.option("--detour-factor", "detour_factor", type=float, default=1.3, help="Detour factor")
+@click.option("--average-speed", "average_speed", type=float, default=30, help="Speed, km/h")
+@click.option("--seed", "seed", type=int, help="Random seed")
+@click_config_file.configuration_option()
+def main(bind_port, latency, error_rate, rate_limit, detour_factor, average_speed, seed):
+    """Run openrouteservice stand-in.
+
+    Point the server to it with --ors-url=http://localhost:<BIND_PORT>
+    """
+    app = create_app(latency, error_rate, rate_limit, detour_factor, average_speed, seed)
+    app.run(port=bind_port, threaded=True)
@@ -0,0 +1,95 @@
+"""Precompute travel times between consecutive route stops."""
+
+import json
+import logging
+import os
+
+import click
+import click_config_file
+
+from .api_service.route import route_client, route_data
+
+logger = logging.getLogger(__name__)
+
+
+def update_segments(segments, fetch, force=False):
+    """Bring segments up to date with loaded routes.
+
+    Segments of stop pairs no longer following each other in any route are
+    dropped, pairs that are new or whose stops have moved are fetched.
+
+    :param list segments: Segments from the file, see _RouteData.load_segments
+    :param callable fetch: Get route summaries: list of (from_point, to_point)
+                           -> list of (duration_seconds, distance_meters) or None per pair
+    :param bool force: Fetch all pairs again
+    :return tuple: (segments, number of fetched pairs, number of failed pairs)
+    """
+    known = {(segment["from"], segment["to"]): segment for segment in segments}
+    locations = {
+        stop: [data["location"]["lat"], data["location"]["lon"]]
+        for stop, data in route_data["stops"].items()
+    }
+    # Unique pairs in order of first appearance
+    pairs = dict.fromkeys(
+        pair for route in route_data["routes"] for pair in route_data.consecutive_pairs(route)
+    )
+
+    result = {}
+    missing = []
+    for pair in pairs:
+        segment = known.get(pair)
+        if (
+            force
+            or segment is None
+            or segment["from_location"] != locations[pair[0]]
+            or segment["to_location"] != locations[pair[1]]
+        ):
+            missing.append(pair)
+        else:
+            result[pair] = segment
+    summaries = fetch([(locations[a], locations[b]) for a, b in missing]) if missing else []
+    failed = 0
+    for (from_stop, to_stop), summary in zip(missing, summaries):
+        if summary is None:
+            logger.warning("No route %s -> %s", from_stop, to_stop)
+            failed += 1
+            continue
+        result[(from_stop, to_stop)] = {
+            "from": from_stop,
+            "to": to_stop,
+            "from_location": locations[from_stop],
+            "to_location": locations[to_stop],
+            "duration": summary[0],
+            "distance": summary[1],
+        }
+    return [result[pair] for pair in pairs if pair in result], len(missing) - failed, failed
+
+
+@click.command()
+@click.option("--routes-json", "routes_json", type=str, required=True, help="Routes json")
+@click.option("--ors-token", "ors_token", type=str, required=True, help="ORS token")
+@click.option("--ors-url", "ors_url", type=str, help="ORS API url")
+@click.option(
+    "--segments-json", "segments_json", type=str, required=True, help="Segments json to update"
+)
+@click.option("--force", "force", is_flag=True, help="Fetch all segments again")
+@click_config_file.configuration_option()
+def main(routes_json, ors_token, ors_url, segments_json, force):
+    """Precompute ORS durations and distances between consecutive stops of every route.
+
+    Only new and changed stop pairs are requested, run it again after editing
+    routes or to retry failed pairs.
+    """
+    logging.basicConfig(level=logging.INFO)
+    route_client.set_config(
+        ors_token, base_url=ors_url or None, matrix_per_minute=0, matrix_per_day=0
+    )
+    route_data.load_from_json(routes_json)
+    segments = []
+    if os.path.exists(segments_json):
+        with open(segments_json, encoding="utf-8") as f:
+            segments = json.load(f)["segments"]
+    segments, fetched, failed = update_segments(segments, route_client.get_ors_segments, force)
+    with open(segments_json, "w", encoding="utf-8") as f:
+        json.dump({"segments": segments}, f, indent=1)
+    click.echo(f"segments={len(segments)} fetched={fetched} failed={failed}")
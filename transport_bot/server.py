@@ -1,30 +1,368 @@
 """Server runner."""
 
 import logging
+import os
 
 import click
 import click_config_file
 
-from .api_service import driver, passenger, schema  # noqa: F401, pylint: disable=unused-import
+from .api_service import (  # noqa: F401, pylint: disable=unused-import
+    driver,
+    passenger,
+    schema,
+    stats,
+)
+from .api_service.board import arrival_board
+from .api_service.eta import MODES, ROUTE, estimator
+from .api_service.fleet import fleet_store
+from .api_service.history import segment_model
+from .api_service.hub import arrival_hub
 from .api_service.route import route_client, route_data
+from .api_service.sweeper import sweeper
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
+logger = logging.getLogger(__name__)
 
 
 @click.command()
 @click.option("--bind-port", "bind_port", type=int, required=True, help="Bind port")
 @click.option("--routes-json", "routes_json", type=str, required=True, help="Routes json")
+@click.option(
+    "--database-uri",
+    "database_uri",
+    type=str,
+    default=schema.MEMORY_DATABASE_URI,
+    help="SQLAlchemy database URI, in-memory SQLite by default",
+)
+@click.option(
+    "--database-pool-size",
+    "database_pool_size",
+    type=int,
+    default=5,
+    help="Database connections kept open",
+)
+@click.option(
+    "--database-max-overflow",
+    "database_max_overflow",
+    type=int,
+    default=10,
+    help="Database connections opened above the pool size at peak load",
+)
 @click.option("--ors-token", "ors_token", type=str, required=True, help="ORS token")
+@click.option("--ors-url", "ors_url", type=str, help="ORS API url")
+@click.option(
+    "--ors-cache-grid", "ors_cache_grid", type=float, default=25, help="ORS cache grid, meters"
+)
+@click.option(
+    "--ors-cache-ttl", "ors_cache_ttl", type=float, default=300, help="ORS cache TTL, seconds"
+)
+@click.option("--ors-cache-size", "ors_cache_size", type=int, default=10000, help="ORS cache size")
+@click.option("--ors-cache-path", "ors_cache_path", type=str, help="ORS cache SQLite file")
+@click.option(
+    "--ors-matrix/--no-ors-matrix", "ors_matrix", default=True, help="Use ORS matrix API"
+)
+@click.option("--ors-workers", "ors_workers", type=int, default=8, help="ORS concurrent requests")
+@click.option(
+    "--ors-deadline",
+    "ors_deadline",
+    type=float,
+    default=0.8,
+    help="ORS time budget per passenger request, seconds",
+)
+@click.option(
+    "--ors-breaker-error-rate",
+    "ors_breaker_error_rate",
+    type=float,
+    default=0.5,
+    help="Share of failed ORS calls that opens circuit breaker",
+)
+@click.option(
+    "--ors-breaker-latency",
+    "ors_breaker_latency",
+    type=float,
+    default=2.0,
+    help="ORS call latency counted as failure, seconds",
+)
+@click.option(
+    "--ors-breaker-cooldown",
+    "ors_breaker_cooldown",
+    type=float,
+    default=30,
+    help="Circuit breaker open time, seconds",
+)
+@click.option(
+    "--detour-factor", "detour_factor", type=float, default=1.3, help="Road to straight distance"
+)
+@click.option(
+    "--average-speed", "average_speed", type=float, default=20, help="Average speed, km/h"
+)
+@click.option(
+    "--nearest-driver-ttl",
+    "nearest_driver_ttl",
+    type=float,
+    default=5,
+    help="Reuse nearest driver result for the same stop and route, seconds",
+)
+@click.option(
+    "--ors-directions-per-minute",
+    "ors_directions_per_minute",
+    type=int,
+    default=40,
+    help="ORS directions requests per minute",
+)
+@click.option(
+    "--ors-directions-per-day",
+    "ors_directions_per_day",
+    type=int,
+    default=2000,
+    help="ORS directions requests per day",
+)
+@click.option(
+    "--ors-matrix-per-minute",
+    "ors_matrix_per_minute",
+    type=int,
+    default=40,
+    help="ORS matrix requests per minute",
+)
+@click.option(
+    "--ors-matrix-per-day",
+    "ors_matrix_per_day",
+    type=int,
+    default=500,
+    help="ORS matrix requests per day",
+)
+@click.option(
+    "--eta-mode",
+    "eta_mode",
+    type=click.Choice(MODES),
+    default=ROUTE,
+    help="Nearest driver by distance along the route line or by ORS routes",
+)
+@click.option(
+    "--off-route-distance",
+    "off_route_distance",
+    type=float,
+    default=0.3,
+    help="Max distance from driver to the route line, km",
+)
+@click.option(
+    "--route-geometry-path", "route_geometry_path", type=str, help="Route geometry cache file"
+)
+@click.option(
+    "--segments-json",
+    "segments_json",
+    type=str,
+    help="Travel times between route stops, see the segments command",
+)
+@click.option(
+    "--eta-ors-cold-segments/--no-eta-ors-cold-segments",
+    "eta_ors_cold_segments",
+    default=True,
+    help="Request from ORS travel times of segments neither learned nor precomputed",
+)
+@click.option(
+    "--history-bucket-minutes",
+    "history_bucket_minutes",
+    type=int,
+    default=60,
+    help="Time of day bucket of learned travel times, minutes",
+)
+@click.option(
+    "--history-min-samples",
+    "history_min_samples",
+    type=int,
+    default=3,
+    help="Min trips to use learned travel time",
+)
+@click.option(
+    "--history-interval",
+    "history_interval",
+    type=float,
+    default=60,
+    help="Seconds between learning runs, 0 to disable",
+)
+@click.option(
+    "--history-retention",
+    "history_retention",
+    type=float,
+    default=7,
+    help="Days to keep location history",
+)
+@click.option(
+    "--arrival-board/--no-arrival-board",
+    "arrival_board_enabled",
+    default=True,
+    help="Compute arrivals on driver updates, route ETA mode only",
+)
+@click.option(
+    "--arrival-board-size",
+    "arrival_board_size",
+    type=int,
+    default=3,
+    help="Drivers on the arrival board of a stop and route",
+)
+@click.option(
+    "--arrival-board-refresh",
+    "arrival_board_refresh",
+    type=float,
+    default=30,
+    help="Seconds between rebuilds of all arrival boards",
+)
+@click.option(
+    "--arrival-stream-max-subscribers",
+    "arrival_stream_max_subscribers",
+    type=int,
+    default=1000,
+    help="Max number of open arrival board streams",
+)
+@click.option(
+    "--fleet-store/--no-fleet-store",
+    "fleet_store_enabled",
+    default=True,
+    help="Keep drivers in memory and write them to the database in background",
+)
+@click.option(
+    "--fleet-flush-interval",
+    "fleet_flush_interval",
+    type=float,
+    default=5,
+    help="Seconds between fleet store writes to the database",
+)
+@click.option(
+    "--fleet-trail-size",
+    "fleet_trail_size",
+    type=int,
+    default=8,
+    help="Last locations kept per driver to tell its heading",
+)
+@click.option(
+    "--stale-silence",
+    "stale_silence",
+    type=float,
+    default=300,
+    help="Seconds without location after which a connected driver is stale, 0 to disable",
+)
+@click.option(
+    "--stale-interval",
+    "stale_interval",
+    type=float,
+    default=30,
+    help="Seconds between stale driver checks",
+)
 @click_config_file.configuration_option()
-def main(bind_port, routes_json, ors_token):
+def main(
+    bind_port,
+    routes_json,
+    database_uri,
+    database_pool_size,
+    database_max_overflow,
+    ors_token,
+    ors_url,
+    ors_cache_grid,
+    ors_cache_ttl,
+    ors_cache_size,
+    ors_cache_path,
+    ors_matrix,
+    ors_workers,
+    ors_deadline,
+    ors_breaker_error_rate,
+    ors_breaker_latency,
+    ors_breaker_cooldown,
+    detour_factor,
+    average_speed,
+    nearest_driver_ttl,
+    ors_directions_per_minute,
+    ors_directions_per_day,
+    ors_matrix_per_minute,
+    ors_matrix_per_day,
+    eta_mode,
+    off_route_distance,
+    route_geometry_path,
+    segments_json,
+    eta_ors_cold_segments,
+    history_bucket_minutes,
+    history_min_samples,
+    history_interval,
+    history_retention,
+    arrival_board_enabled,
+    arrival_board_size,
+    arrival_board_refresh,
+    arrival_stream_max_subscribers,
+    fleet_store_enabled,
+    fleet_flush_interval,
+    fleet_trail_size,
+    stale_silence,
+    stale_interval,
+):
     """Run transport bot server applications.
 
     Provides command to run transport bot
     """
-    route_client.set_config(ors_token)
+    route_client.set_config(
+        ors_token,
+        cache_grid=ors_cache_grid,
+        cache_ttl=ors_cache_ttl,
+        cache_size=ors_cache_size,
+        cache_path=ors_cache_path or None,
+        use_matrix=ors_matrix,
+        workers=ors_workers,
+        deadline=ors_deadline or None,
+        breaker_error_rate=ors_breaker_error_rate,
+        breaker_latency=ors_breaker_latency,
+        breaker_cooldown=ors_breaker_cooldown,
+        detour_factor=detour_factor,
+        average_speed=average_speed,
+        directions_per_minute=ors_directions_per_minute,
+        directions_per_day=ors_directions_per_day,
+        matrix_per_minute=ors_matrix_per_minute,
+        matrix_per_day=ors_matrix_per_day,
+        base_url=ors_url or None,
+    )
+    passenger.nearest_driver_flight.set_config(ttl=nearest_driver_ttl)
+    estimator.set_config(
+        mode=eta_mode, off_route=off_route_distance, ors_cold_segments=eta_ors_cold_segments
+    )
+    segment_model.set_config(
+        bucket_minutes=history_bucket_minutes,
+        min_samples=history_min_samples,
+        retention=history_retention,
+        off_route=off_route_distance,
+    )
     route_data.load_from_json(routes_json)
+    if eta_mode == ROUTE:
+        route_data.load_geometries(
+            route_client.get_ors_route_geometry, route_geometry_path or None
+        )
+        if segments_json and os.path.exists(segments_json):
+            route_data.load_segments(segments_json)
+        elif segments_json:
+            logger.warning("No %s, run the segments command to create it", segments_json)
+    schema.set_database(
+        database_uri, pool_size=database_pool_size, max_overflow=database_max_overflow
+    )
     with schema.app.app_context():
         schema.db.create_all()
-        schema.app.run(port=bind_port)
+        for name in schema.upgrade_database():
+            logger.info("Database upgraded: added %s", name)
+        segment_model.load()
+        if fleet_store_enabled:
+            fleet_store.set_config(trail_size=fleet_trail_size)
+            fleet_store.load()
+            fleet_store.start(schema.app, fleet_flush_interval)
+        if stale_silence:
+            sweeper.set_config(silence=stale_silence)
+            sweeper.start(schema.app, stale_interval)
+        if history_interval:
+            segment_model.start(schema.app, history_interval)
+        if arrival_board_enabled and eta_mode == ROUTE:
+            arrival_board.set_config(size=arrival_board_size)
+            arrival_hub.set_config(max_subscribers=arrival_stream_max_subscribers)
+            arrival_board.start(schema.app, arrival_board_refresh)
+        try:
+            schema.app.run(port=bind_port)
+        finally:
+            if fleet_store_enabled:
+                fleet_store.stop()
+                fleet_store.flush()